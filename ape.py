@@ -1,6 +1,24 @@
 #!/usr/bin/env python3
-import mutagen.apev2 as ape
+"""reads and writes APEv2 tags (for dts and ac3 files)
+
+several files can be given at once. with --manifest, each file gets its own
+tags, read from a file of JSON lines:
+
+    {"file": "01.dts", "tags": [["TITLE", "Intro"], ["TRACKNUMBER", "1"]], "delete_all": true}
+
+or of KEY=VALUE lines (as for qtag), with an @filename line before each file:
+
+    @01.dts
+    TITLE=Intro
+    TRACKNUMBER=1
+
+so a whole box set can be tagged by one process.
+"""
 import argparse
+import json
+import sys
+
+import tagfile
 
 def main():
     parser = argparse.ArgumentParser()
@@ -10,22 +28,88 @@ def main():
     parser.add_argument('-l', '--list', action='store_true')
     parser.add_argument('--delete-all', action='store_true')
     parser.add_argument('--import', dest='import_', type=argparse.FileType('r'), metavar="file")
-    parser.add_argument('filename')
+    parser.add_argument('--manifest', type=argparse.FileType('r'), metavar="file", help="read per-file tags from file (- for stdin)")
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar="N", help="tag N files at once")
+    parser.add_argument('filenames', nargs='*', metavar='filename')
     args = parser.parse_args()
 
-    f = ape.APEv2File(args.filename)
+    tags = []
+    if args.import_:
+        tags += read_import(args.import_)
+    if args.tags:
+        tags += parse_tags(args.tags)
 
-    if args.list:
-        if f.tags:
-            print(f.tags.pprint())
+    edits = [(filename, tags, args.delete_all) for filename in args.filenames]
+    if args.manifest:
+        edits += read_manifest(args.manifest, tags, args.delete_all)
+    if not edits:
+        parser.error("no files given")
+
+    if args.list or args.get:
+        for filename, _, _ in edits:
+            if len(edits) > 1 and args.list:
+                print("%s:" % filename)
+            show(filename, args)
+        if args.list:
+            return
+
+    if not any(tags or delete_all for _, tags, delete_all in edits):
         return
 
-    if args.get and f.tags:
-        for tag in args.get:
-            print(f.tags.get(tag, ''))
+    if not tagfile.report_updates(tagfile.update_many(edits, save, args.jobs)):
+        sys.exit(1)
+
+def parse_tags(lines):
+    tags = []
+    for t in lines:
+        if '=' not in t:
+            print("invalid tag:", t)
+            continue
+        name, _, value = t.partition('=')
+        tags.append((name, value))
+    return tags
 
-    if args.delete_all:
-        if args.tags or args.import_:
+def read_import(f):
+    return parse_tags(t for t in (line.strip() for line in f) if t)
+
+def read_manifest(f, common_tags=(), delete_all=False):
+    """returns a list of (filename, tags, delete_all) from a manifest.
+    common_tags (from --tag and --import) are set on every file"""
+    edits = []
+    lines = iter(f)
+    for line in lines:
+        t = line.strip()
+        if not t or t.startswith('#'):
+            continue
+        if t.startswith('{'):
+            # JSON lines
+            for line in [line] + list(lines):
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                tags = entry.get("tags", [])
+                if isinstance(tags, dict):
+                    tags = list(tags.items())
+                edits.append((entry["file"], list(common_tags) + [tuple(x) for x in tags],
+                               entry.get("delete_all", delete_all)))
+            break
+        if t.startswith('@'):
+            edits.append((t[1:], list(common_tags), delete_all))
+        elif not edits:
+            raise Exception("manifest: tags before the first @filename line")
+        else:
+            edits[-1][1].extend(parse_tags([t]))
+    return edits
+
+def save(filename, tags, delete_all=False):
+    """sets tags (a list of (name, value)) on a file, after deleting the
+    existing tags if delete_all is set. later values replace earlier ones."""
+    import mutagen.apev2 as ape
+
+    f = ape.APEv2File(filename)
+
+    if delete_all:
+        if tags:
             # we're going to add tags later, so just clear the tags dict for now
             # (if there are no tags yet, do nothing)
             if f.tags is not None:
@@ -36,33 +120,81 @@ def main():
             # this will remove the entire APEv2 chunk
             # it does nothing if f.tags is not set
             f.delete()
+            tagfile.invalidate(filename)
             return
 
-    if not args.tags and not args.import_:
+    if not tags:
         return
 
     if f.tags is None:
         f.add_tags()
 
-    if args.import_:
-        for line in args.import_:
-            t = line.strip()
-            if not t:
-                continue
-            if '=' not in t:
-                print("invalid tag:", t)
-                continue
-            name, _, value = t.partition('=')
-            f.tags[name] = value
-
-    if args.tags:
-        for t in args.tags:
-            if '=' not in t:
-                print("invalid tag:", t)
-                continue
-            name, _, value = t.partition('=')
-            f.tags[name] = value
+    for name, value in tags:
+        f.tags[name] = value
 
     f.save()
+    tagfile.invalidate(filename)
+
+def show(filename, args):
+    # --list and --get are answered without loading mutagen,
+    # since qtag and rename.py run this for every file
+    if read_only(filename, args):
+        return
+
+    import mutagen.apev2 as ape
+
+    f = ape.APEv2File(filename)
+
+    if args.list:
+        if f.tags:
+            print(f.tags.pprint())
+        return
+
+    if args.get and f.tags:
+        for tag in args.get:
+            print(f.tags.get(tag, ''))
+
+TEXT, BINARY, EXTERNAL = 0, 1, 2
+
+def read_only(filename, args):
+    """does what mutagen would for --list and --get, using tagfile.
+    returns False if the tag has something that needs mutagen to print"""
+    items = tagfile.read_ape_items(filename)
+    if items is None:
+        return True
+
+    # like mutagen, keys are case-insensitive and the last item wins
+    tags = {}
+    try:
+        for key, flags, value in items:
+            kind = (flags >> 1) & 3
+            if kind == TEXT or kind == EXTERNAL:
+                value = value.decode('utf-8')
+            elif kind != BINARY:
+                return False
+            tags[key.lower()] = (key, kind, value)
+    except UnicodeDecodeError:
+        return False
+
+    if args.list:
+        if tags:
+            print("\n".join("%s=%s" % (key, pprint(kind, value)) for key, kind, value in sorted(tags.values())))
+        return True
+
+    if args.get and tags:
+        for tag in args.get:
+            key, kind, value = tags.get(tag.lower(), (tag, TEXT, ''))
+            if kind == BINARY:
+                return False
+            print(value)
+    return True
+
+def pprint(kind, value):
+    if kind == BINARY:
+        return "[%d bytes]" % len(value)
+    if kind == EXTERNAL:
+        return "[External] %s" % value
+    return " / ".join(value.split("\0"))
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""benchmarks the in-process fast paths against the slow paths they replaced.
+
+    python3 bench.py tags [-n repeat] files...
+    python3 bench.py dts14 [-n repeat] [--size MB]
+    python3 bench.py toc [-n repeat] files...
+    python3 bench.py importtime [-n repeat] [scripts...]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+def measure(name, fn, count, unit, repeat=1):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            print("%-12s skipped (%s)" % (name, e))
+            return None
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    rate = count / best if best > 0 else float('inf')
+    print("%-12s %8.3f s  %10.1f %s/s" % (name, best, rate, unit))
+    return best
+
+def read_tag_subprocess(filename, tag, opus_cache):
+    """rename.read_tag as it was before it read tags itself, for comparison:
+    one metaflac or ape.py run per tag, and one opustags run per file"""
+    if filename.endswith(".opus"):
+        if filename not in opus_cache:
+            tags = {}
+            last_key = ""
+            try:
+                output = subprocess.check_output(["opustags", filename]).decode('utf-8')
+            except subprocess.CalledProcessError:
+                output = ""
+            for line in output.splitlines():
+                if last_key and line.startswith("\t"):
+                    tags[last_key] += "\n" + line[1:]
+                else:
+                    k, _, v = line.partition('=')
+                    tags[k] = v
+                    last_key = k
+            opus_cache[filename] = tags
+        return opus_cache[filename].get(tag, "")
+
+    if filename.endswith(".dts") or filename.endswith(".ac3"):
+        cmd = ["python3", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ape.py"), "--get="+tag, filename]
+    else:
+        cmd = ["metaflac", "--show-tag="+tag, filename]
+    try:
+        value = subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode("utf-8")
+    except subprocess.CalledProcessError:
+        return ""
+    if value.lower().startswith(tag.lower()+"="):
+        value = value[len(tag)+1:]
+    return value.strip("\n\t ")
+
+def bench_tags(args):
+    import tagfile
+
+    # the tags that rename.py -d -a asks for
+    names = ['TITLE', 'TRACKNUMBER', 'DISCNUMBER', 'DISCTOTAL', 'ARTIST']
+
+    def inprocess():
+        for filename in args.files:
+            tagfile.read_tags(filename)
+
+    def subprocess():
+        opus_cache = {}
+        for filename in args.files:
+            for tag in names:
+                read_tag_subprocess(filename, tag, opus_cache)
+
+    print("%d files, %d tags each" % (len(args.files), len(names)))
+    fast = measure("in-process", inprocess, len(args.files), "files", args.repeat)
+    slow = measure("subprocess", subprocess, len(args.files), "files", args.repeat)
+    if fast and slow:
+        print("speedup: %.1fx" % (slow / fast))
+
+def convert_struct(f, out):
+    """dts14.convert as it was before it was vectorized, for comparison"""
+    import struct
+    unpack = struct.Struct("<hhhhhhhh").unpack
+    while 1:
+        data = f.read(16)
+        if len(data) < 16:
+            break
+        bits = 0
+        for n in unpack(data):
+            assert -0x2000 <= n <= 0x1fff, hex(n)
+            bits = (bits<<14) + (n&0x3fff)
+        out.write(bits.to_bytes(14, 'big'))
+
+def bench_dts14(args):
+    import io
+    import random
+    import dts14
+    from array import array
+
+    size = int(args.size * (1<<20)) // 16 * 16
+    words = array('h', (random.randrange(-0x2000, 0x2000) for _ in range(size//2)))
+    if sys.byteorder == 'big':
+        words.byteswap()
+    data = words.tobytes()
+
+    outputs = {}
+    def run(name, convert):
+        def fn():
+            out = io.BytesIO()
+            convert(io.BytesIO(data), out)
+            outputs[name] = out.getvalue()
+        return fn
+
+    engines = [("struct", convert_struct)]
+    engines.append(("bytes", lambda f, out: dts14.convert(f, out, pack=dts14.pack_bytes)))
+    if dts14.numpy is not None:
+        engines.append(("numpy", lambda f, out: dts14.convert(f, out, pack=dts14.pack_numpy)))
+    else:
+        print("numpy       skipped (not installed)")
+
+    print("%.1f MB of input" % (size / (1<<20)))
+    for name, convert in engines:
+        measure(name, run(name, convert), size / (1<<20), "MB", args.repeat)
+
+    if len(set(outputs.values())) > 1:
+        print("error: outputs differ")
+        sys.exit(1)
+
+def get_toc_mutagen(tracks):
+    """ctdb.get_toc as it was before it read the headers itself, for comparison"""
+    import wave
+    import mutagen.flac
+
+    toc = []
+    t = 0
+    for filename in tracks:
+        toc.append(t // 588)
+
+        if filename.endswith(".wav"):
+            f = wave.open(filename, 'rb')
+            if f.getframerate() != 44100 or f.getnchannels() != 2:
+                raise Exception("%s: not a 44100 Hz stereo track" % filename)
+            length = f.getnframes()
+            f.close()
+        else:
+            f = mutagen.flac.Open(filename)
+            if f.info.sample_rate != 44100 or f.info.channels != 2:
+                raise Exception("%s: not a 44100 Hz stereo track" % filename)
+
+            length = f.info.total_samples * 44100 // f.info.sample_rate
+        t += length
+    toc.append((t + 588 - 1) // 588)
+
+    return toc
+
+def bench_toc(args):
+    import ctdb
+
+    tocs = {}
+    def run(name, get_toc):
+        def fn():
+            ctdb._track_info.clear()
+            tocs[name] = get_toc(args.files)
+        return fn
+
+    def startup(name, code):
+        # a fresh interpreter each time, so import costs are counted
+        def fn():
+            subprocess.run([sys.executable, "-c", code] + args.files, check=True, cwd=sys.path[0] or None)
+        return fn
+
+    print("%d files" % len(args.files))
+    measure("headers", run("headers", ctdb.get_toc), len(args.files), "files", args.repeat)
+    measure("threaded", run("threaded", lambda files: ctdb.get_toc(files, jobs=8)), len(args.files), "files", args.repeat)
+    measure("mutagen", run("mutagen", get_toc_mutagen), len(args.files), "files", args.repeat)
+
+    print("startup, including the interpreter:")
+    measure("headers", startup("headers", "import sys, ctdb; ctdb.get_toc(sys.argv[1:])"), 1, "runs", args.repeat)
+    # ctdb used to import mutagen whether or not it needed it
+    measure("mutagen", startup("mutagen", "import sys, ctdb, bench; bench.get_toc_mutagen(sys.argv[1:])"), 1, "runs", args.repeat)
+
+    if len(set(tuple(toc) for toc in tocs.values())) > 1:
+        print("error: tocs differ")
+        sys.exit(1)
+
+# the scripts that are run over and over by qtag, rename.py and batch jobs
+SCRIPTS = ['ctdb.py', 'ape.py', 'mbquery', 'rename.py', 'seekpoints.py', 'qtag', 'renumber.py']
+
+def importtime(script, args):
+    """runs script with python -X importtime and returns the wall time
+    and a list of (cumulative microseconds, module) for its top-level imports"""
+    start = time.perf_counter()
+    p = subprocess.run([sys.executable, "-X", "importtime", script] + args,
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    imports = []
+    for line in p.stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue # the header
+        name = fields[2]
+        # nested imports are indented under the module that imported them
+        if name.startswith("  "):
+            continue
+        imports.append((int(fields[1]), name.strip()))
+    return elapsed, imports
+
+def bench_importtime(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    scripts = args.scripts or SCRIPTS
+    print("%-14s %9s %9s  %s" % ("script", "wall", "imports", "heaviest imports"))
+    for script in scripts:
+        path = script if os.path.exists(script) else os.path.join(here, script)
+        best = None
+        for _ in range(args.repeat):
+            elapsed, imports = importtime(path, ["--help"])
+            if best is None or elapsed < best[0]:
+                best = elapsed, imports
+        elapsed, imports = best
+        # site is imported before the script runs, so don't count it
+        ours = [(us, name) for us, name in imports if name not in ("site", "encodings")]
+        total = sum(us for us, _ in ours)
+        heaviest = ", ".join("%s %.1fms" % (name, us/1000) for us, name in sorted(ours, reverse=True)[:3])
+        print("%-14s %7.1fms %7.1fms  %s" % (os.path.basename(script), elapsed*1000, total/1000, heaviest))
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='benchmark', metavar='benchmark')
+    sub.required = True
+
+    p = sub.add_parser('tags', help="read tags in-process vs. metaflac/opustags/ape.py")
+    p.add_argument('-n', '--repeat', type=int, default=3, help="take the best of N runs")
+    p.add_argument('files', nargs='+')
+    p.set_defaults(func=bench_tags)
+
+    p = sub.add_parser('dts14', help="dtswav conversion throughput")
+    p.add_argument('-n', '--repeat', type=int, default=3, help="take the best of N runs")
+    p.add_argument('--size', type=float, default=16, metavar='MB', help="amount of input to convert")
+    p.set_defaults(func=bench_dts14)
+
+    p = sub.add_parser('toc', help="ctdb.get_toc reading headers vs. mutagen, in-process and from startup")
+    p.add_argument('-n', '--repeat', type=int, default=3, help="take the best of N runs")
+    p.add_argument('files', nargs='+')
+    p.set_defaults(func=bench_toc)
+
+    p = sub.add_parser('importtime', help="cold-start time of each script, and what it spends importing (python -X importtime)")
+    p.add_argument('-n', '--repeat', type=int, default=3, help="take the best of N runs")
+    p.add_argument('scripts', nargs='*', help="scripts to time (default: %s)" % " ".join(SCRIPTS))
+    p.set_defaults(func=bench_importtime)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
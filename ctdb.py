@@ -3,177 +3,913 @@ import sys
 import os
 import argparse
 import subprocess
-import sqlite3
+import threading
+import time
 import zlib
 from collections import namedtuple
 
-import wave
-import mutagen.flac
-import requests
-from xml.etree import ElementTree
+import flacmeta
+import riff
+import xdg
+
+# requests, sqlite3, json, ElementTree, concurrent.futures and tagfile
+# (which loads json and tempfile) are imported where they're used, so
+# that a lookup that's answered from the cache, or a --help, doesn't pay
+# to load them
 
 CTDBEntry = namedtuple("CTDBEntry", "confidence, crc32, stride, trackcrcs")
+TrackInfo = namedtuple("TrackInfo", "sample_rate, channels, bits_per_sample, samples")
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--pregap", type=int, help="pregap frames")
+    parser.add_argument("--backend", choices=["python", "go"], default="python", help="compute CRCs in-process, or with sox and ctdb_crc32 (default: python)")
+    parser.add_argument("-t", "--tracks", action="store_true", help="check each track against the track CRCs")
+    parser.add_argument("--batch", action="store_true", help="verify every album under the given directories and print a JSON report for each")
+    parser.add_argument("-j", "--jobs", type=int, metavar="N",
+                        help="with --batch, verify N albums at once (default: one per cpu); otherwise read N track headers at once (default: 1)")
+    parser.add_argument("--lookups", type=int, default=4, metavar="N", help="with --batch, make N database lookups at once")
+    parser.add_argument("--prefetch", action="store_true", help="fill the cache with the tocs listed (one per line) in the given files, or - for stdin")
+    parser.add_argument("--find-crc", action="store_true", help="list the cached albums that have the given disc or track CRCs")
+    parser.add_argument("--server", default=LOOKUP_URL, metavar="URL", help="CTDB lookup url (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=10, metavar="SECONDS", help="give up on a request after this long (default %(default)s)")
+    parser.add_argument("--retries", type=int, default=3, metavar="N", help="retry failed requests N times, backing off exponentially (default %(default)s)")
+    parser.add_argument("--rate", type=float, default=2, metavar="N", help="make at most N requests per second (default %(default)s)")
     parser.add_argument("files", nargs="+")
     args = parser.parse_args()
 
-    toc = get_toc(args.files)
+    if (args.tracks or args.batch) and args.backend == "go":
+        parser.error("--tracks and --batch need the python backend")
+
+    client = CTDBClient(args.server, timeout=args.timeout, retries=args.retries, rate=args.rate, connections=args.lookups)
+
+    if args.find_crc:
+        found = False
+        for crc in args.files:
+            for tocstr, track, confidence in find_crc(int(crc, 16)):
+                where = "disc" if track is None else "track %d" % track
+                print(f"{crc} {where} confidence {confidence} toc {tocstr}")
+                found = True
+        if not found:
+            sys.exit(1)
+        return
+
+    if args.prefetch:
+        fetched, errors = prefetch(read_tocs(args.files), client=client, lookups=args.lookups)
+        print("fetched %d tocs" % fetched)
+        if errors:
+            sys.exit(1)
+        return
+
+    if args.batch:
+        if not batch(args.files, jobs=args.jobs, lookups=args.lookups, client=client):
+            sys.exit(1)
+        return
+
+    # reading the headers one at a time is quicker for an album on a local
+    # disk; threads only help on slow or networked storage
+    toc = get_toc(args.files, jobs=args.jobs or 1)
 
     if args.pregap:
         toc[0] = args.pregap
 
-    info = lookup_toc(toc)
+    info = lookup_toc(toc, client=client)
     if not info:
         print("album not in database")
         sys.exit(1)
 
-    os.environ['PATH'] += os.pathsep + os.path.dirname(__file__)
-    effects = []
-    if args.pregap:
-        effects += ["trim", str(args.pregap*588)+"s"]
-    p1 = subprocess.Popen(["sox", "--no-clobber"] + args.files + ["-t", "s16", "-"] + effects, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
-    p2 = subprocess.Popen(["ctdb_crc32"] + [entry.crc32 for entry in info], stdin=p1.stdout, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-
-    p1.stdout.close()
-    out = p2.stdout.read()
-    p2.stdout.close()
-    p2.wait()
-    p1.wait()
+    if args.tracks:
+        if not verify_tracks(args.files, toc, info):
+            sys.exit(1)
+        return
 
-    # TODO: note highest confidence entry
+    by_crc = index_entries(info)
+    if args.backend == "go":
+        found = scan_offsets_go(args.files, args.pregap, by_crc)
+    else:
+        found = scan_offsets(args.files, args.pregap, by_crc)
 
     matches = 0
-    for line in out.decode().splitlines():
-        offset, c = line.split()
-        for entry in info:
-            if entry.crc32 == c or int(entry.crc32, 16) == int(c, 16):
-                print(f"Found match at offset {offset} with confidence {entry.confidence} and CRC {entry.crc32}")
-                matches += 1
+    best = None
+    for offset, c in found:
+        for entry in by_crc[c]:
+            print(f"Found match at offset {offset} with confidence {entry.confidence} and CRC {entry.crc32}", flush=True)
+            matches += 1
+            if best is None or entry_confidence(entry) > entry_confidence(best[1]):
+                best = offset, entry
 
     if not matches:
         print(f"No matches found")
         sys.exit(1)
 
-def get_toc(tracks):
+    offset, entry = best
+    print(f"Best match at offset {offset} with confidence {entry.confidence} and CRC {entry.crc32}")
+
+def index_entries(info):
+    """returns a dict mapping each disc crc (as an int) to its entries"""
+    by_crc = {}
+    for entry in info:
+        by_crc.setdefault(int(entry.crc32, 16), []).append(entry)
+    return by_crc
+
+def entry_confidence(entry):
+    return int(entry.confidence or 0)
+
+def verify_tracks(files, toc, info):
+    """prints the offsets and confidence at which each track matches.
+    returns whether every track matched"""
+    ok = True
+    for i, matches in enumerate(scan_tracks(files, toc, info)):
+        if not matches:
+            print(f"Track {i+1}: no match ({files[i]})")
+            ok = False
+            continue
+        for offset, entry in matches:
+            print(f"Track {i+1}: match at offset {offset} with confidence {entry.confidence} and CRC {entry.trackcrcs[i]}")
+    return ok
+
+def scan_offsets_go(files, pregap, wanted):
+    """runs the audio through sox and ctdb_crc32.
+    yields (offset, crc) pairs for the crcs in wanted as ctdb_crc32 finds them"""
+    os.environ['PATH'] += os.pathsep + os.path.dirname(__file__)
+    effects = []
+    if pregap:
+        effects += ["trim", str(pregap*588)+"s"]
+    p1 = subprocess.Popen(["sox", "--no-clobber"] + files + ["-t", "s16", "-"] + effects, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    p2 = subprocess.Popen(["ctdb_crc32"] + ["%08x" % c for c in wanted], stdin=p1.stdout, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
 
+    p1.stdout.close()
+    try:
+        for line in p2.stdout:
+            offset, c = line.split()
+            yield int(offset), int(c, 16)
+    finally:
+        p2.stdout.close()
+        p2.wait()
+        p1.wait()
+
+FRAME_SAMPLES = 588
+FRAME_BYTES = FRAME_SAMPLES * 4
+LEADIN = 10 * FRAME_SAMPLES # samples skipped at the start and end of the disc
+READ_SIZE = 1<<20
+
+def scan_offsets(files, pregap, wanted):
+    """computes the ctdb crc of the audio in files at every offset in the
+    leadin/leadout range, like ctdb_crc32 but in-process.
+    yields (offset, crc) pairs for the crcs in wanted as they're found"""
+    skip = pregap*FRAME_BYTES if pregap else 0
+    for offset, c, _ in rolling_crcs(skip_bytes(read_audio(files), skip)):
+        if c in wanted:
+            yield offset, c
+
+def scan_tracks(files, toc, info):
+    """checks the crc of every track against the track crcs of every entry
+    in info, at every offset, in one pass over the audio.
+    returns a list with a list of (offset, entry) matches for each track"""
+    _, tracks = scan_album(files, toc, info)
+    return tracks
+
+def scan_album(files, toc, info):
+    """checks the crc of the disc and of every track against every entry
+    in info, at every offset, in one pass over the audio.
+    returns a list of (offset, entry) matches for the disc,
+    and a list of them for each track"""
+    entries = [e for e in info if len(e.trackcrcs) == len(files)]
+    if len(entries) < len(info):
+        print("warning: ignoring %d entries with the wrong number of tracks" % (len(info) - len(entries)), file=sys.stderr)
+    wanted = [{} for _ in files]
+    for entry in entries:
+        for i, c in enumerate(entry.trackcrcs):
+            wanted[i].setdefault(int(c, 16), []).append(entry)
+    disc_wanted = index_entries(info)
+
+    # track starts, in samples from the start of the trimmed audio
+    starts = [(t - toc[0]) * FRAME_SAMPLES for t in toc[1:-1]]
+    skip = toc[0]*FRAME_BYTES
+    disc = []
+    tracks = [[] for _ in files]
+    for offset, crc, trackcrcs in rolling_crcs(skip_bytes(read_audio(files), skip), starts):
+        for entry in disc_wanted.get(crc, ()):
+            disc.append((offset, entry))
+        for i, c in enumerate(trackcrcs):
+            for entry in wanted[i].get(c, ()):
+                tracks[i].append((offset, entry))
+    return disc, tracks
+
+AUDIO_EXTENSIONS = (".flac", ".wav")
+
+def find_albums(dirs):
+    """walks dirs and groups the audio files into albums: one per directory,
+    or one per DISCNUMBER if a directory holds several discs.
+    yields (name, files) with the files in track order"""
+    for topdir in dirs:
+        for path, dirnames, filenames in os.walk(topdir):
+            dirnames.sort()
+            filenames = sorted(x for x in filenames if x.endswith(AUDIO_EXTENSIONS))
+            discs = {}
+            for x in filenames:
+                filename = os.path.join(path, x)
+                tags = {}
+                if filename.endswith(".flac"):
+                    try:
+                        tags = read_flac_header(filename)
+                    except Exception as e:
+                        print("warning: %s: %s" % (filename, e), file=sys.stderr)
+                disc = tags.get("DISCNUMBER", "").split("/")[0].strip()
+                discs.setdefault(disc, []).append((track_number(tags), x, filename))
+            for disc in sorted(discs, key=track_number_key):
+                name = path if len(discs) == 1 else "%s (disc %s)" % (path, disc)
+                yield name, [filename for _, _, filename in sorted(discs[disc])]
+
+def read_flac_header(filename):
+    """returns the tags of a flac file, and remembers its STREAMINFO
+    for get_toc while the file is open"""
+    import tagfile
+
+    with open(filename, 'rb') as f:
+        st = os.fstat(f.fileno())
+        blocks = flacmeta.read_blocks(f, want={flacmeta.STREAMINFO, flacmeta.VORBIS_COMMENT})
+    block = flacmeta.find_block(blocks, flacmeta.STREAMINFO)
+    if block is not None:
+        remember_track_info(filename, st, streaminfo_track_info(flacmeta.parse_streaminfo(block.data)))
+    block = flacmeta.find_block(blocks, flacmeta.VORBIS_COMMENT)
+    if block is None:
+        return {}
+    return tagfile.parse_vorbis_comment(block.data)
+
+def track_number(tags):
+    return track_number_key(tags.get("TRACKNUMBER", ""))
+
+def track_number_key(s):
+    s = s.split("/")[0].strip()
+    return (0, int(s), "") if s.isdigit() else (1, 0, s)
+
+def batch(dirs, jobs=None, lookups=4, client=None):
+    """verifies every album under dirs, printing a JSON report for each.
+    database lookups run in a thread pool and overlap with the crc
+    computations, which run in a process pool.
+    returns whether every album matched"""
+    import json
+    import multiprocessing
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    # the crc workers are started after the lookup threads are running, and
+    # forking then could copy a lock (in requests, sqlite, ...) that one of
+    # those threads holds. forkserver starts them from a clean process instead
+    ok = True
+    crc_context = multiprocessing.get_context('forkserver')
+    with ThreadPoolExecutor(lookups) as lookup_pool, ProcessPoolExecutor(jobs, mp_context=crc_context) as crc_pool:
+        pending = {lookup_pool.submit(lookup_album, files, client): (name, files) for name, files in find_albums(dirs)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                name, files = pending.pop(fut)
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    result = {"status": "error", "error": str(e)}
+                if isinstance(result, dict):
+                    report = {"album": name, "files": files}
+                    report.update(result)
+                    ok = ok and report["status"] == "ok"
+                    print(json.dumps(report), flush=True)
+                else:
+                    toc, info = result
+                    pending[crc_pool.submit(check_album, files, toc, info)] = (name, files)
+    return ok
+
+def lookup_album(files, client):
+    """returns the toc and ctdb entries for an album,
+    or a report if there's nothing to check"""
+    # albums are already looked up in parallel
+    toc = get_toc(files)
+    info = lookup_toc(toc, client=client)
+    if not info:
+        return {"status": "not found", "toc": ':'.join(str(x) for x in toc)}
+    return toc, info
+
+def check_album(files, toc, info):
+    """returns a report of which offsets and entries the disc and each track match"""
+    disc, tracks = scan_album(files, toc, info)
+    def match(offset, entry, crc):
+        return {"offset": offset, "confidence": entry_confidence(entry), "crc32": crc}
+    report = {
+        "status": "ok" if disc and all(tracks) else "mismatch",
+        "toc": ':'.join(str(x) for x in toc),
+        "matches": [match(offset, e, e.crc32) for offset, e in disc],
+        "tracks": [[match(offset, e, e.trackcrcs[i]) for offset, e in t] for i, t in enumerate(tracks)],
+    }
+    return report
+
+def read_audio(files):
+    """yields the audio in files as one stream of 16-bit stereo pcm.
+    wav files are read directly; flac files are decoded by flac(1),
+    since decoding flac in python would be far too slow."""
+    for filename in files:
+        if filename.endswith(".wav"):
+            with open(filename, 'rb') as f:
+                fmt, _, size = riff.read_header(f)
+                if fmt.format != riff.WAVE_FORMAT_PCM or fmt.bits_per_sample != 16:
+                    raise Exception("%s: not a 16-bit pcm track" % filename)
+                while size is None or size > 0:
+                    buf = f.read(READ_SIZE if size is None else min(size, READ_SIZE))
+                    if not buf:
+                        break
+                    if size is not None:
+                        size -= len(buf)
+                    yield buf
+        else:
+            with open(filename, 'rb') as f:
+                blocks = flacmeta.read_blocks(f, want={flacmeta.STREAMINFO})
+            info = flacmeta.parse_streaminfo(flacmeta.find_block(blocks, flacmeta.STREAMINFO).data)
+            if info.bits_per_sample != 16:
+                raise Exception("%s: not a 16-bit track" % filename)
+            p = subprocess.Popen(["flac", "-d", "-c", "-s", "--force-raw-format", "--endian=little", "--sign=signed", filename], stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+            try:
+                while True:
+                    buf = p.stdout.read(READ_SIZE)
+                    if not buf:
+                        break
+                    yield buf
+            finally:
+                p.stdout.close()
+                if p.wait() != 0:
+                    raise Exception("%s: flac exited with status %d" % (filename, p.returncode))
+
+def skip_bytes(chunks, n):
+    for buf in chunks:
+        if n >= len(buf):
+            n -= len(buf)
+            continue
+        if n:
+            buf = buf[n:]
+            n = 0
+        yield buf
+
+# crc arithmetic, after zlib's crc32_combine.
+# crcs are in zlib's bit-reflected form, so x^0 is 1<<31.
+
+CRC_POLY = 0xedb88320
+
+def multmodp(a, b):
+    """multiplies two polynomials modulo the crc polynomial"""
+    m = 1<<31
+    p = 0
+    while a:
+        if a & m:
+            p ^= b
+            a ^= m
+        m >>= 1
+        b = (b >> 1) ^ CRC_POLY if b & 1 else b >> 1
+    return p
+
+_x2n = [1<<30] # x^(2^n)
+for _ in range(31):
+    _x2n.append(multmodp(_x2n[-1], _x2n[-1]))
+
+def x8nmodp(n):
+    """returns x^(8n) modulo the crc polynomial"""
+    k = 3 # 8 bits per byte
+    p = 1<<31
+    while n:
+        if n & 1:
+            p = multmodp(_x2n[k & 31], p)
+        n >>= 1
+        k += 1
+    return p
+
+def shift_crc(c, n):
+    """returns the unmasked crc register c after feeding it n zero bytes.
+    shift_crc(crc1, len(b)) ^ crc2 is the crc of a+b, like zlib's crc32_combine"""
+    return multmodp(x8nmodp(n), c)
+
+class RollingCRC:
+    """the crc32 of a window of fixed length sliding along a stream,
+    four bytes (one stereo sample) at a time. a port of lib.RollingCRC,
+    except that the window length is fixed up front, so that dropping
+    the old bytes is four table lookups instead of a multiplication."""
+
+    def __init__(self, crc, length):
+        """crc is the crc32 of the first length bytes of the stream"""
+        self.crc = crc
+        # the effect of byte b, at position k of the word leaving the window,
+        # on the crc of that word followed by length more bytes.
+        # it's linear in b, so only the single bits need to be shifted
+        p = x8nmodp(length)
+        zero = zlib.crc32(bytes(4))
+        self.tables = []
+        for k in range(4):
+            bits = []
+            for j in range(8):
+                word = bytes(k) + bytes([1<<j]) + bytes(3 - k)
+                bits.append(multmodp(p, zlib.crc32(word) ^ zero))
+            t = [0] * 256
+            for b in range(1, 256):
+                low = b & -b
+                t[b] = t[b ^ low] ^ bits[low.bit_length() - 1]
+            self.tables.append(t)
+        # lengthening the message by four bytes changes the effect of the
+        # 0xffffffff initial value; this undoes it
+        self.fixup = shift_crc(0xffffffff, length + 4) ^ multmodp(p, 0xffffffff)
+
+    def update(self, old, new):
+        """slides the window along by one word. old is the word leaving
+        the window and new is the word entering it"""
+        t0, t1, t2, t3 = self.tables
+        self.crc = zlib.crc32(new, self.crc) ^ self.fixup ^ t0[old[0]] ^ t1[old[1]] ^ t2[old[2]] ^ t3[old[3]]
+
+def rolling_crcs(chunks, starts=()):
+    """yields (offset, crc, trackcrcs) for every offset in the leadin/leadout
+    range, where crc is the ctdb crc32 of the audio from chunks, shifted by
+    offset samples (the same sweep as ctdb_crc32), and trackcrcs are the
+    crcs of each track, shifted the same way. starts are the positions
+    of the second and later tracks, in samples.
+
+    the length of the audio isn't known until the end, so everything but
+    a tail big enough to hold the longest possible leadin and leadout is
+    checksummed as it is read. each track's checksum starts where its first
+    window begins, and the words around each track boundary are kept
+    for rolling the windows later."""
+    tail_max = 4 * (LEADIN + 2*LEADIN)
+    cuts = [0] + [max(0, 4*(s - LEADIN)) for s in starts]
+    edges = [bytearray() for _ in cuts] # the words after each cut
+    segcrcs = []
+    crc = 0
+    crcpos = 0
+    tail = b''
+    total = 0
+
+    def checksum(data):
+        nonlocal crc, crcpos
+        data = memoryview(data)
+        while len(segcrcs) + 1 < len(cuts) and crcpos + len(data) >= cuts[len(segcrcs)+1]:
+            n = cuts[len(segcrcs)+1] - crcpos
+            segcrcs.append(zlib.crc32(data[:n], crc))
+            crc = 0
+            crcpos += n
+            data = data[n:]
+        crc = zlib.crc32(data, crc)
+        crcpos += len(data)
+
+    for buf in chunks:
+        for cut, edge in zip(cuts, edges):
+            lo = cut + len(edge)
+            if len(edge) < tail_max and total <= lo < total + len(buf):
+                edge += buf[lo - total:lo - total + tail_max - len(edge)]
+        total += len(buf)
+        tail += buf
+        if len(tail) > 2*tail_max:
+            n = len(tail) - tail_max
+            checksum(memoryview(tail)[:n])
+            tail = tail[n:]
+
+    if total < 20 * FRAME_BYTES:
+        raise Exception("input length %d is too short" % total)
+    if total % 4 != 0:
+        print("warning: input length %d is not a multiple of 4 bytes" % total, file=sys.stderr)
+    samples = total // 4
+    if samples % FRAME_SAMPLES != 0:
+        print("warning: audio length %d is not a multiple of %d samples" % (samples, FRAME_SAMPLES), file=sys.stderr)
+
+    leadin = LEADIN
+    leadout = LEADIN + samples % LEADIN
+    width = leadin + leadout
+
+    # the first window starts at 0 and stops short of the leadin and leadout
+    n = len(tail) - 4*width - total%4
+    length = 4*samples - 4*width
+    if length < cuts[-1]:
+        raise Exception("audio is shorter than the toc")
+    checksum(memoryview(tail)[:n])
+    tail = tail[n:]
+    segcrcs.append(crc)
+
+    ends = cuts[1:] + [length]
+    seglens = [end - cut for cut, end in zip(cuts, ends)]
+    crc = segcrcs[0]
+    for c, seglen in zip(segcrcs[1:], seglens[1:]):
+        crc = shift_crc(crc, seglen) ^ c
+    r = RollingCRC(crc, length)
+
+    tracks = [RollingCRC(c, seglen) for c, seglen in zip(segcrcs, seglens)]
+    olds = edges
+    news = edges[1:] + [tail]
+    head = edges[0]
+    for i in range(width + 1):
+        yield i - leadin, r.crc, [t.crc for t in tracks]
+        if i != width:
+            j = 4*i
+            r.update(head[j:j+4], tail[j:j+4])
+            for t, old, new in zip(tracks, olds, news):
+                t.update(old[j:j+4], new[j:j+4])
+
+def get_toc(tracks, jobs=1):
+    return toc_from_infos(tracks, track_infos(tracks, jobs))
+
+def toc_from_infos(tracks, infos):
+    """works out the toc of an album from the TrackInfo of each track"""
     toc = []
     t = 0
-    for filename in tracks:
+    for filename, info in zip(tracks, infos):
         toc.append(t // 588)
+        if info.sample_rate != 44100 or info.channels != 2:
+            raise Exception("%s: not a 44100 Hz stereo track" % filename)
+        t += info.samples
+    toc.append((t + 588 - 1) // 588)
 
+    return toc
+
+def track_infos(tracks, jobs=1):
+    """reads the headers of several tracks, jobs at a time"""
+    if jobs > 1 and len(tracks) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(min(jobs, len(tracks))) as pool:
+            return list(pool.map(track_info, tracks))
+    return [track_info(filename) for filename in tracks]
+
+# filename -> ((size, mtime), TrackInfo)
+_track_info = {}
+
+def track_info(filename):
+    """returns the format and length of a track, reading only the
+    STREAMINFO block of a flac file or the fmt and data chunk headers
+    of a wav file. results are remembered until the file changes"""
+    st = os.stat(filename)
+    key = (st.st_size, st.st_mtime_ns)
+    cached = _track_info.get(filename)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    with open(filename, 'rb') as f:
         if filename.endswith(".wav"):
-            f = wave.open(filename, 'rb')
-            if f.getframerate() != 44100 or f.getnchannels() != 2:
-                raise Exception("%s: not a 44100 Hz stereo track" % filename)
-            length = f.getnframes()
-            f.close()
+            fmt, _, size = riff.read_header(f)
+            if size is None:
+                raise Exception("%s: unknown data size" % filename)
+            info = TrackInfo(fmt.sample_rate, fmt.channels, fmt.bits_per_sample, size // fmt.block_align)
         else:
-            f = mutagen.flac.Open(filename)
-            if f.info.sample_rate != 44100 or f.info.channels != 2:
-                raise Exception("%s: not a 44100 Hz stereo track" % filename)
+            # the STREAMINFO block always comes first
+            head = f.read(42)
+            if len(head) < 42 or head[:4] != b'fLaC' or head[4] & 0x7f != flacmeta.STREAMINFO:
+                raise Exception("%s: not a flac file" % filename)
+            info = streaminfo_track_info(flacmeta.parse_streaminfo(head[8:42]))
 
-            length = f.info.total_samples * 44100 // f.info.sample_rate
-        t += length
-    toc.append((t + 588 - 1) // 588)
+    _track_info[filename] = (key, info)
+    return info
 
-    return toc
+def streaminfo_track_info(si):
+    return TrackInfo(si.sample_rate, si.channels, si.bits_per_sample, si.total_samples)
 
-def lookup_toc(toc):
+def remember_track_info(filename, st, info):
+    """saves header info that was read some other way, for track_info"""
+    _track_info[filename] = ((st.st_size, st.st_mtime_ns), info)
+
+def lookup_toc(toc, client=None):
     tocstr = ':'.join(str(x) for x in toc)
 
     print(f"info: toc={tocstr}", file=sys.stderr)
 
-    add_to_cache = False
-    content = lookup_from_cache(tocstr)
-    if content == None:
-        add_to_cache = True
-        content = lookup_from_web(tocstr)
-        if not content:
-            return None
-
-    info = parse_ctdb_xml(content)
+    info = lookup_from_cache(tocstr)
+    if info == None:
+        content = lookup_from_web(tocstr, client=client)
+        info = parse_ctdb_xml(content) if content else []
+        save_to_cache(tocstr, content if info else None, info)
 
-    if info and add_to_cache:
-        save_to_cache(tocstr, content)
+    return info or None
 
-    return info
+# how long to remember that a toc isn't in the database
+NEGATIVE_TTL = 7*24*60*60 # seconds
 
-db = None
+# each thread gets its own connection, since sqlite connections can't be shared
+_local = threading.local()
+_evicted = False
+_migrate_lock = threading.Lock()
 def open_db():
-    global db
+    db = getattr(_local, 'db', None)
     if db != None:
         return db
 
-    cachedir = os.environ.get("XDG_CACHE_HOME")
-    if not cachedir:
-        cachedir = os.path.expanduser("~/.cache")
-    cachedir  = os.path.join(cachedir, "ctdb")
-    try:
-        os.mkdir(cachedir)
-    except FileExistsError:
-        pass
+    dbfile = os.path.join(xdg.cache_dir("ctdb"), "ctdb.sqlite")
+    import sqlite3
+    db = sqlite3.connect(dbfile, timeout=30)
+    # WAL lets readers carry on while another worker is writing
+    db.execute("PRAGMA journal_mode = WAL;").close()
+    with _migrate_lock:
+        migrate(db)
+    _local.db = db
+    return db
 
-    dbfile = os.path.join(cachedir, "ctdb.sqlite")
-    db = sqlite3.connect(dbfile)
+def migrate(db):
+    global _evicted
     ver, = db.execute("PRAGMA user_version;").fetchone()
 
-    if ver < 1:
-        db.executescript("""
-            BEGIN;
+    if ver < 1 and begin_upgrade(db, 1):
+        db.execute("""
             CREATE TABLE IF NOT EXISTS ctdb (
                 toc TEXT,
                 content BLOB,
                 mtime TIMESTAMP DEFAULT current_timestamp
-            );
-            CREATE UNIQUE INDEX IF NOT EXISTS ctdb_index ON ctdb (toc);
-            PRAGMA user_version = 1;
-            COMMIT;
-        """).close()
+            )""").close()
+        db.execute("CREATE UNIQUE INDEX IF NOT EXISTS ctdb_index ON ctdb (toc)").close()
+        db.execute("PRAGMA user_version = 1;").close()
+        db.commit()
+
+    if ver < 2 and begin_upgrade(db, 2):
+        # negative entries: tocs that aren't in the database have found = 0
+        # and no content, and expire after NEGATIVE_TTL
+        db.execute("ALTER TABLE ctdb ADD COLUMN found INTEGER NOT NULL DEFAULT 1").close()
+        db.execute("CREATE INDEX IF NOT EXISTS ctdb_mtime ON ctdb (found, mtime)").close()
+        db.execute("PRAGMA user_version = 2;").close()
+        db.commit()
+
+    if ver < 3 and begin_upgrade(db, 3):
+        # the decoded entries of every cached toc, so that a cache hit
+        # doesn't have to parse the xml, and so crcs can be searched
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                toc TEXT,
+                entry INTEGER,
+                confidence INTEGER,
+                crc32 INTEGER,
+                stride INTEGER,
+                PRIMARY KEY (toc, entry)
+            )""").close()
+        db.execute("CREATE INDEX IF NOT EXISTS entries_crc32 ON entries (crc32)").close()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS trackcrcs (
+                toc TEXT,
+                entry INTEGER,
+                track INTEGER,
+                crc32 INTEGER,
+                PRIMARY KEY (toc, entry, track)
+            )""").close()
+        db.execute("CREATE INDEX IF NOT EXISTS trackcrcs_crc32 ON trackcrcs (crc32)").close()
+        rows = db.execute("SELECT toc, content FROM ctdb WHERE found").fetchall()
+        for tocstr, content in rows:
+            _save_entries(db, tocstr, parse_ctdb_xml(zlib.decompress(content)))
+        db.execute("PRAGMA user_version = 3;").close()
+        db.commit()
+
+    if not _evicted:
+        _evicted = True
+        evict_expired(db)
+
+def begin_upgrade(db, version):
+    """starts a write transaction for upgrading the cache to version.
+    returns False, with nothing started, if another process got there first"""
+    db.execute("BEGIN IMMEDIATE;").close()
+    ver, = db.execute("PRAGMA user_version;").fetchone()
+    if ver >= version:
+        db.rollback()
+        return False
+    return True
 
-    return db
+def _expiry():
+    return "-%d seconds" % NEGATIVE_TTL
+
+def evict_expired(db):
+    """deletes negative entries that are older than NEGATIVE_TTL"""
+    with db:
+        db.execute("DELETE FROM ctdb WHERE found = 0 AND mtime < datetime('now', ?)", (_expiry(),)).close()
 
 def lookup_from_cache(tocstr):
+    """returns the cached entries for a toc, [] if the toc is known not to be
+    in the database, or None if it isn't cached"""
     db = open_db()
-    cur = db.execute("SELECT content FROM ctdb WHERE toc = ?", (tocstr,))
+    cur = db.execute("SELECT found FROM ctdb WHERE toc = ? AND (found OR mtime >= datetime('now', ?))", (tocstr, _expiry()))
     row = cur.fetchone()
     cur.close()
     if row == None:
         return None
+    if not row[0]:
+        print("info: found in cache (not in database)", file=sys.stderr)
+        return []
     print("info: found in cache", file=sys.stderr)
-    return zlib.decompress(row[0])
 
-def save_to_cache(tocstr, content):
+    tracks = {}
+    for entry, crc in db.execute("SELECT entry, crc32 FROM trackcrcs WHERE toc = ? ORDER BY entry, track", (tocstr,)):
+        tracks.setdefault(entry, []).append("%08x" % crc)
+    info = []
+    for entry, confidence, crc, stride in db.execute("SELECT entry, confidence, crc32, stride FROM entries WHERE toc = ? ORDER BY entry", (tocstr,)):
+        info.append(CTDBEntry(str(confidence), "%08x" % crc, None if stride is None else str(stride), tracks.get(entry, [])))
+    return info
+
+def save_to_cache(tocstr, content, info=None):
+    """caches the xml for a toc. content is None if the toc isn't in the database.
+    info is the parsed content, if the caller has it already"""
+    save_many_to_cache([(tocstr, content, info)])
+
+def save_many_to_cache(results):
+    """caches a list of (toc, content) or (toc, content, info) tuples in one transaction"""
+    rows = []
+    entries = []
+    for tocstr, content, *info in results:
+        if content:
+            rows.append((tocstr, zlib.compress(content), 1))
+            entries.append((tocstr, info[0] if info and info[0] is not None else parse_ctdb_xml(content)))
+        else:
+            rows.append((tocstr, None, 0))
+            entries.append((tocstr, []))
     db = open_db()
     with db:
-        db.execute(
-            "INSERT INTO ctdb(toc, content) VALUES (:1, :2)" +
-            "ON CONFLICT(toc) DO UPDATE SET content = :2, mtime = current_timestamp",
-            (tocstr, zlib.compress(content))).close()
+        db.executemany(
+            "INSERT INTO ctdb(toc, content, found) VALUES (:1, :2, :3)" +
+            "ON CONFLICT(toc) DO UPDATE SET content = :2, found = :3, mtime = current_timestamp",
+            rows).close()
+        for tocstr, info in entries:
+            _save_entries(db, tocstr, info)
+
+def _save_entries(db, tocstr, info):
+    db.execute("DELETE FROM entries WHERE toc = ?", (tocstr,)).close()
+    db.execute("DELETE FROM trackcrcs WHERE toc = ?", (tocstr,)).close()
+    db.executemany("INSERT INTO entries(toc, entry, confidence, crc32, stride) VALUES (?, ?, ?, ?, ?)",
+        [(tocstr, i, entry_confidence(e), int(e.crc32, 16), int(e.stride) if e.stride else None) for i, e in enumerate(info)]).close()
+    db.executemany("INSERT INTO trackcrcs(toc, entry, track, crc32) VALUES (?, ?, ?, ?)",
+        [(tocstr, i, t+1, int(c, 16)) for i, e in enumerate(info) for t, c in enumerate(e.trackcrcs)]).close()
+
+def find_crc(crc):
+    """returns (toc, track, confidence) for every cached entry with the given
+    crc, either for the whole disc (track is None) or for one track"""
+    db = open_db()
+    cur = db.execute("""
+        SELECT toc, NULL, confidence FROM entries WHERE crc32 = :1
+        UNION ALL
+        SELECT t.toc, t.track, e.confidence FROM trackcrcs t
+            JOIN entries e ON e.toc = t.toc AND e.entry = t.entry
+            WHERE t.crc32 = :1
+        """, (crc,))
+    rows = cur.fetchall()
+    cur.close()
+    return rows
 
-def lookup_from_web(tocstr):
+def uncached_tocs(tocs):
+    """returns the tocs that aren't cached, or whose negative entries have expired"""
+    db = open_db()
+    cached = set()
+    for i in range(0, len(tocs), 500):
+        chunk = tocs[i:i+500]
+        cur = db.execute("SELECT toc FROM ctdb WHERE toc IN (%s) AND (found OR mtime >= datetime('now', ?))" % ",".join("?"*len(chunk)),
+                         chunk + [_expiry()])
+        cached.update(toc for toc, in cur)
+        cur.close()
+    return [toc for toc in tocs if toc not in cached]
+
+def prefetch(tocs, client=None, lookups=4):
+    """looks up every toc that isn't already cached, lookups at a time,
+    and saves the results to the cache in large batches.
+    returns the number of tocs fetched and the number of errors"""
+    tocs = list(dict.fromkeys(tocs))
+    missing = uncached_tocs(tocs)
+    print("info: %d of %d tocs not cached" % (len(missing), len(tocs)), file=sys.stderr)
+
+    def fetch(tocstr):
+        content = lookup_from_web(tocstr, client=client)
+        info = parse_ctdb_xml(content) if content else []
+        return tocstr, content if info else None, info
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    results = []
+    errors = 0
+    with ThreadPoolExecutor(lookups) as pool:
+        futures = [pool.submit(fetch, toc) for toc in missing]
+        for fut in as_completed(futures):
+            try:
+                results.append(fut.result())
+            except Exception as e:
+                print("error: %s" % e, file=sys.stderr)
+                errors += 1
+            if len(results) >= 1000:
+                save_many_to_cache(results)
+                results = []
+    save_many_to_cache(results)
+    return len(missing) - errors, errors
+
+def read_tocs(filenames):
+    """reads tocs from files (or stdin, for -), one per line"""
+    for filename in filenames:
+        f = sys.stdin if filename == "-" else open(filename)
+        with f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    yield line
+
+LOOKUP_URL = 'http://db.cuetools.net/lookup2.php'
+
+def lookup_from_web(tocstr, client=None):
     print("info: fetching from web", file=sys.stderr)
-    url = 'http://db.cuetools.net/lookup2.php'
-    params = {
-        'version': '3',
-        'ctdb': '1',
-        'metadata': 'fast', # fast, default, or extensive
-        'fuzzy': '1',
-        'toc': tocstr,
-    }
-
-    resp = requests.get(url, params)
-    if resp.status_code == 404:
+    if client is None:
+        client = default_client()
+    return client.lookup(tocstr)
+
+_default_client = None
+_default_client_lock = threading.Lock()
+def default_client():
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = CTDBClient()
+        return _default_client
+
+class CTDBClient:
+    """makes lookup requests to the ctdb over one persistent session,
+    so connections are reused. requests time out, are retried with
+    exponential backoff on server errors and connection failures,
+    and are rate limited so that batch runs don't hammer the server.
+    safe to share between threads."""
+
+    def __init__(self, url=LOOKUP_URL, timeout=10, retries=3, backoff=1, rate=2, burst=None, connections=4):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate, burst if burst is not None else max(1, rate))
+        self.connections = connections
+        self.session = None
+        self.lock = threading.Lock()
+
+    def _session(self):
+        # made on first use, so that importing requests is only paid for
+        # when something isn't in the cache
+        with self.lock:
+            if self.session is None:
+                import requests
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.connections)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.session = session
+            return self.session
+
+    def lookup(self, tocstr):
+        """returns the xml for a toc, or None if the toc isn't in the database"""
+        params = {
+            'version': '3',
+            'ctdb': '1',
+            'metadata': 'fast', # fast, default, or extensive
+            'fuzzy': '1',
+            'toc': tocstr,
+        }
+
+        import requests
+        session = self._session()
+        attempt = 0
+        while True:
+            self.bucket.take()
+            try:
+                resp = session.get(self.url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * 2**attempt
+                print("info: %s, retrying in %gs" % (e.__class__.__name__, delay), file=sys.stderr)
+            else:
+                if resp.status_code == 404:
+                    return None
+                if resp.status_code < 500 or attempt >= self.retries:
+                    resp.raise_for_status()
+                    return resp.content
+                delay = retry_after(resp) or self.backoff * 2**attempt
+                print("info: server error %d, retrying in %gs" % (resp.status_code, delay), file=sys.stderr)
+            time.sleep(delay)
+            attempt += 1
+
+def retry_after(resp):
+    try:
+        return float(resp.headers.get('Retry-After', ''))
+    except ValueError:
         return None
-    resp.raise_for_status()
 
-    return resp.content
+class TokenBucket:
+    """allows rate events per second on average, and bursts of up to burst events"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """waits until a token is available, then takes it"""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        # the token is reserved, so other threads can queue up behind us
+        # while we sleep
+        if wait > 0:
+            time.sleep(wait)
 
 def parse_ctdb_xml(content):
     ns = {'Z': 'http://db.cuetools.net/ns/mmd-1.0#'}
 
+    from xml.etree import ElementTree
+
     root = ElementTree.fromstring(content)
     assert root.tag == '{'+ns['Z']+'}ctdb', root.tag
 
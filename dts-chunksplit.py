@@ -3,50 +3,93 @@ this can be useful for splitting a dts stream extracted from a dtswav,
 which has 00 padding at the track boundaries in order to align the
 start of a dts frame to the start of the track."""
 
+import os
 import sys
-f = open(sys.argv[1], 'rb')
-
-SYNC = b'\x7f\xfe\x80\x01'
-
-track = 1
-out = open("track%02d.dts" % track, 'xb')
-
-blocks = 0
-pos = 0
-while 1:
-    header = f.peek(10)
-    if len(header) == 0:
-        print("done")
-        break
-    if header[0:4] != SYNC:
-        print("desync at %#x" % pos)
-        if header[0:4] == b'\x00\x00\x00\x00':
-            haystack = f.read(4096)
-            i = haystack.find(SYNC)
-            if i >= 0:
-                out.write(haystack[:i])
-                out.close()
-                pos += i
-                print("resync at %#x (+%#x)" % (pos, i))
-                f.seek(pos, 0)
-                track += 1
-                out = open("track%02d.dts" % track, 'xb')
-                print("starting track", track)
-                continue
-        print("lost sync")
-        out.write(haystack)
-        break
-
-    x = header[7] + (header[6]<<8) + (header[5]<<16)
-    fsize = ((x >> 4) & 0x3fff) + 1
-    if fsize != 0xe00:
-        print("fsize=%#x at %#x" % (fsize, pos))
-    data = f.read(fsize)
-    out.write(data)
-    pos += fsize
-    blocks += 1
-
-out.close()
-
-print(blocks, "blocks")
+import dts
+from dts import SYNC
 
+def main():
+    # the input can be - to read from a pipe
+    if sys.argv[1] == '-':
+        split_stream(dts.open_input('-'))
+    else:
+        split_file(sys.argv[1])
+
+def split_file(filename):
+    """splits a file using its frame index, copying each track in one go"""
+    index = dts.load_index(filename)
+
+    cuts = [0]
+    with open(filename, 'rb') as f:
+        gaps = list(index.iter_gaps())
+        g = 0
+        for offset, fsize in zip(index.offsets, index.sizes):
+            while g < len(gaps) and gaps[g][0] < offset:
+                pos, length = gaps[g]
+                print("desync at %#x" % pos)
+                if os.pread(f.fileno(), 4, pos) == b'\x00\x00\x00\x00':
+                    print("resync at %#x (+%#x)" % (pos + length, length))
+                    cuts.append(pos + length)
+                    print("starting track", len(cuts))
+                else:
+                    print("resync at %#x (+%#x), not splitting" % (pos + length, length))
+                g += 1
+            if fsize != 0xe00:
+                print("fsize=%#x at %#x" % (fsize, offset))
+        if g < len(gaps):
+            print("desync at %#x" % gaps[g][0])
+            print("lost sync")
+        else:
+            print("done")
+        cuts.append(index.size)
+
+        for track in range(1, len(cuts)):
+            start, end = cuts[track-1], cuts[track]
+            with open("track%02d.dts" % track, 'xb') as out:
+                dts.copy_range(f.fileno(), out.fileno(), start, end - start)
+
+    print(len(index), "blocks")
+
+def split_stream(f):
+    track = 1
+    out = open("track%02d.dts" % track, 'xb')
+
+    blocks = 0
+    pos = 0
+    while 1:
+        header = f.peek(10)
+        if len(header) == 0:
+            print("done")
+            break
+        if header[0:4] != SYNC:
+            print("desync at %#x" % pos)
+            if header[0:4] == b'\x00\x00\x00\x00':
+                haystack = f.peek(4096)
+                i = haystack.find(SYNC)
+                if i >= 0:
+                    out.write(f.read(i))
+                    out.close()
+                    pos += i
+                    print("resync at %#x (+%#x)" % (pos, i))
+                    track += 1
+                    out = open("track%02d.dts" % track, 'xb')
+                    print("starting track", track)
+                    continue
+            print("lost sync")
+            out.write(f.read(4096))
+            break
+
+        fsize, _ = dts.parse_header(header)
+        if fsize != 0xe00:
+            print("fsize=%#x at %#x" % (fsize, pos))
+        data = f.read(fsize)
+        out.write(data)
+        pos += fsize
+        blocks += 1
+
+    out.close()
+
+    print(blocks, "blocks")
+
+if __name__ == '__main__':
+    main()
@@ -1,36 +1,25 @@
 """finds places where a DTS stream loses sync"""
 import sys
-f = open(sys.argv[1], 'rb')
+import dts
 
-SYNC = b'\x7f\xfe\x80\x01'
+index = dts.load_index(sys.argv[1])
 
-blocks = 0
-pos = 0
-while 1:
-    header = f.peek(10)
-    if len(header) == 0:
-        print("done")
-        break
-    if header[0:4] != SYNC:
+# walk the frames and gaps in stream order
+gaps = list(index.iter_gaps())
+g = 0
+for offset, fsize in zip(index.offsets, index.sizes):
+    while g < len(gaps) and gaps[g][0] < offset:
+        pos, length = gaps[g]
         print("desync at %#x" % pos)
-        if header[0:4] == b'\x00\x00\x00\x00':
-            haystack = f.read(4096)
-            i = haystack.find(SYNC)
-            if i >= 0:
-                pos += i
-                print("resync at %#x (+%#x)" % (pos, i))
-                f.seek(pos, 0)
-                continue
-        print("lost sync")
-        break
-
-    x = header[7] + (header[6]<<8) + (header[5]<<16)
-    fsize = ((x >> 4) & 0x3fff) + 1
+        print("resync at %#x (+%#x)" % (pos + length, length))
+        g += 1
     if fsize != 0xe00:
-        print("fsize=%#x at %#x" % (fsize, pos))
-    f.seek(fsize, 1)
-    pos += fsize
-    blocks += 1
-
-print(blocks, "blocks")
+        print("fsize=%#x at %#x" % (fsize, offset))
+if g < len(gaps):
+    # trailing garbage
+    print("desync at %#x" % gaps[g][0])
+    print("lost sync")
+else:
+    print("done")
 
+print(len(index), "blocks")
@@ -0,0 +1,276 @@
+"""bits shared by the dts scripts"""
+import errno
+import fcntl
+import mmap
+import os
+import stat
+import struct
+import sys
+from array import array
+
+SYNC = b'\x7f\xfe\x80\x01'
+
+HEADER_SIZE = 10
+
+READ_SIZE = 1<<16
+
+def parse_header(header):
+    """returns (frame size, samples per frame) from a frame header"""
+    x = int.from_bytes(header[4:10], byteorder='big')
+    fsize = ((x >> 20) & 0x3fff) + 1
+    nblks = (x >> 34) & 0x7f
+    return fsize, 32 * (nblks + 1)
+
+class Stream:
+    """wraps a file so that it can peek any distance ahead without seeking,
+    which means the dts scripts can read from a pipe."""
+
+    def __init__(self, f):
+        self.f = f
+        self.name = getattr(f, 'name', '-')
+        self.buf = b''
+        self.pos = 0 # read position in buf
+        self.offset = 0 # read position in the stream
+
+    def peek(self, n):
+        """returns the next n bytes without consuming them (fewer at eof)"""
+        if len(self.buf) - self.pos < n:
+            self.buf = self.buf[self.pos:] + self.f.read(max(n, READ_SIZE))
+            self.pos = 0
+        return self.buf[self.pos:self.pos+n]
+
+    def read(self, n):
+        data = self.peek(n)
+        self.pos += len(data)
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def seekable(self):
+        """reports whether the stream is a regular file that can be copied from by offset"""
+        try:
+            return stat.S_ISREG(os.fstat(self.f.fileno()).st_mode)
+        except (AttributeError, OSError, ValueError):
+            return False
+
+    def skip(self, n):
+        """consumes n bytes without reading them. the stream must be seekable"""
+        if n <= len(self.buf) - self.pos:
+            self.pos += n
+        else:
+            self.buf = b''
+            self.pos = 0
+            self.f.seek(self.offset + n)
+        self.offset += n
+
+def open_input(filename):
+    """opens a file for reading, or stdin if filename is -"""
+    if filename == '-':
+        return Stream(sys.stdin.buffer)
+    return Stream(open(filename, 'rb'))
+
+class FrameIndex:
+    """the offset, size and sample count of every frame in a dts stream,
+    and the offset and length of every gap between frames where the stream
+    lost sync. built by scanning the stream once; see load_index."""
+
+    MAGIC = b'DTSIDX01'
+    _header = struct.Struct('<8sQqQQ')
+
+    def __init__(self):
+        self.offsets = array('Q')
+        self.sizes = array('H')
+        self.samples = array('H')
+        self.gaps = array('Q') # offset, length, offset, length, ...
+        self.size = 0 # length of the stream
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def iter_gaps(self):
+        g = self.gaps
+        return zip(g[0::2], g[1::2])
+
+    def scan(self, buf):
+        """indexes every frame in buf, which is usually an mmap of the whole file.
+        after losing sync, a sync word only counts if it's followed by
+        another one a frame later (or by the end of the stream)."""
+        size = len(buf)
+        find = buf.find
+        add_offset = self.offsets.append
+        add_size = self.sizes.append
+        add_samples = self.samples.append
+        pos = 0
+        while pos < size:
+            if buf[pos:pos+4] == SYNC and pos + HEADER_SIZE <= size:
+                fsize, samples = parse_header(buf[pos:pos+HEADER_SIZE])
+                if pos + fsize <= size:
+                    add_offset(pos)
+                    add_size(fsize)
+                    add_samples(samples)
+                    pos += fsize
+                    continue
+
+            # lost sync. look for the next frame
+            j = find(SYNC, pos + 1)
+            while j >= 0:
+                if j + HEADER_SIZE <= size:
+                    fsize, _ = parse_header(buf[j:j+HEADER_SIZE])
+                    if j + fsize == size or buf[j+fsize:j+fsize+4] == SYNC:
+                        break
+                j = find(SYNC, j + 1)
+            if j < 0:
+                j = size
+            self.gaps.append(pos)
+            self.gaps.append(j - pos)
+            pos = j
+        self.size = size
+
+    def save(self, filename, st):
+        """writes the index to filename. st is the stat of the indexed file,
+        which load checks to make sure the index is still current."""
+        arrays = [self.offsets, self.sizes, self.samples, self.gaps]
+        if sys.byteorder == 'big':
+            arrays = [array(a.typecode, a) for a in arrays]
+            for a in arrays:
+                a.byteswap()
+        with open(filename, 'wb') as f:
+            f.write(self._header.pack(self.MAGIC, st.st_size, st.st_mtime_ns, len(self.offsets), len(self.gaps)))
+            for a in arrays:
+                a.tofile(f)
+
+    @classmethod
+    def load(cls, filename, st):
+        """reads an index saved by save. returns None if it doesn't
+        match the file described by st."""
+        with open(filename, 'rb') as f:
+            header = f.read(cls._header.size)
+            if len(header) < cls._header.size:
+                return None
+            magic, size, mtime, nframes, ngaps = cls._header.unpack(header)
+            if magic != cls.MAGIC or size != st.st_size or mtime != st.st_mtime_ns:
+                return None
+            index = cls()
+            try:
+                index.offsets.fromfile(f, nframes)
+                index.sizes.fromfile(f, nframes)
+                index.samples.fromfile(f, nframes)
+                index.gaps.fromfile(f, ngaps)
+            except EOFError:
+                return None
+        if sys.byteorder == 'big':
+            for a in (index.offsets, index.sizes, index.samples, index.gaps):
+                a.byteswap()
+        index.size = size
+        return index
+
+def scan_fd(fd):
+    """builds the FrameIndex of the regular file open on fd (which can be
+    stdin, when it's redirected from a file), from its start"""
+    index = FrameIndex()
+    if os.fstat(fd).st_size > 0:
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as m:
+            index.scan(m)
+    return index
+
+def index_filename(filename):
+    return filename + '.idx'
+
+def load_index(filename, sidecar=False):
+    """returns the FrameIndex for a dts file, by scanning it.
+    if sidecar is set, the index is read from the sidecar file (filename.idx)
+    when there's a current one, and saved there for next time otherwise.
+    it's off by default so that nothing is written next to the user's media
+    unless they ask for it."""
+    st = os.stat(filename)
+    idxfile = index_filename(filename)
+    if sidecar:
+        try:
+            index = FrameIndex.load(idxfile, st)
+            if index is not None:
+                return index
+        except OSError:
+            pass
+
+    with open(filename, 'rb') as f:
+        index = scan_fd(f.fileno())
+
+    if sidecar:
+        try:
+            index.save(idxfile, st)
+        except OSError as e:
+            print("warning: couldn't save index: %s" % e, file=sys.stderr)
+    return index
+
+# copy_range falls back to the next method when it gets one of these
+_unsupported = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                errno.ENOTSUP, errno.ENOTTY, errno.ENOTSOCK}
+
+COPY_SIZE = 1<<20
+
+def copy_range(src, dst, offset, length=None, reflink=False):
+    """copies length bytes (or everything up to eof, if length is None) from
+    offset in the file descriptor src to the current position of dst.
+    returns the number of bytes copied, which is short only at eof.
+
+    the data is copied by the kernel where possible, trying in turn:
+    a reflink (if asked for, and only on filesystems that support it),
+    copy_file_range, sendfile, and finally large reads and writes."""
+    size = os.fstat(src).st_size
+    if length is None or offset + length > size:
+        length = max(0, size - offset)
+
+    start = os.lseek(dst, 0, os.SEEK_CUR)
+    methods = [_copy_file_range, _sendfile, _read_write]
+    if reflink:
+        methods.insert(0, _clone_range)
+    for method in methods:
+        done = os.lseek(dst, 0, os.SEEK_CUR) - start
+        if done >= length:
+            break
+        try:
+            method(src, dst, offset + done, length - done)
+        except OSError as e:
+            if e.errno not in _unsupported:
+                raise
+    return os.lseek(dst, 0, os.SEEK_CUR) - start
+
+FICLONERANGE = 0x4020940d
+
+def _clone_range(src, dst, offset, length):
+    # this only works if offset and length are aligned to the filesystem's block size
+    pos = os.lseek(dst, 0, os.SEEK_CUR)
+    fcntl.ioctl(dst, FICLONERANGE, struct.pack('qQQQ', src, offset, length, pos))
+    os.lseek(dst, pos + length, os.SEEK_SET)
+
+def _copy_file_range(src, dst, offset, length):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, "copy_file_range not available")
+    while length > 0:
+        n = os.copy_file_range(src, dst, length, offset)
+        if n == 0:
+            break
+        offset += n
+        length -= n
+
+def _sendfile(src, dst, offset, length):
+    while length > 0:
+        n = os.sendfile(dst, src, offset, length)
+        if n == 0:
+            break
+        offset += n
+        length -= n
+
+def _read_write(src, dst, offset, length):
+    while length > 0:
+        buf = os.pread(src, min(length, COPY_SIZE), offset)
+        if not buf:
+            break
+        os.write(dst, buf)
+        offset += len(buf)
+        length -= len(buf)
@@ -1,30 +1,156 @@
-"""converts a dtswav file (with 14-bit packing) to a normal dts file"""
+"""converts a dtswav file (with 14-bit packing) to a normal dts file
+
+input and output default to stdin and stdout, so extraction, conversion
+and splitting can run as one pipeline:
+
+    flac -dc dtscd.flac | python3 dts14.py | python3 dts-chunksplit.py -
+"""
 import sys
-import struct
+import argparse
+import queue
+import threading
+
+import riff
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CHUNK_SIZE = 1<<22 # bytes of input per iteration; must be a multiple of 16
 
 def main():
-    f = open(sys.argv[1], "rb")
-    f.read(0x2c)
-    out = sys.stdout.buffer
-    if len(sys.argv) > 2:
-        out = open(sys.argv[2], "xb")
-    convert(f, out)
-    f.close()
-    if out != sys.stdout.buffer:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", nargs="?", default="-", help="dtswav file (default: stdin)")
+    parser.add_argument("output", nargs="?", default="-", help="dts file to create (default: stdout)")
+    args = parser.parse_args()
+
+    f = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+    out = sys.stdout.buffer if args.output == "-" else open(args.output, "xb")
+
+    fmt, offset, size = riff.read_header(f)
+    if fmt.format != riff.WAVE_FORMAT_PCM or fmt.bits_per_sample != 16:
+        sys.exit("error: %s is not a 16-bit pcm wav file" % args.input)
+
+    with DoubleBuffer(out) as w:
+        convert(f, w, offset=offset, size=size)
+
+    if f is not sys.stdin.buffer:
+        f.close()
+    if out is not sys.stdout.buffer:
         out.close()
 
-def convert(f, out):
-    unpack = struct.Struct("<hhhhhhhh").unpack
-    #for i in range(1000):
-    while 1:
-        data = f.read(16)
-        if len(data) < 16:
+def convert(f, out, offset=0, size=None, pack=None):
+    """converts 14-bit packed words from f to a dts stream on out.
+    offset is the position of f in the input file, for error messages.
+    if size is given, stop after that many bytes of input.
+
+    every 8 little-endian 16-bit words hold 8*14 bits of the stream,
+    so each 16 bytes of input become 14 bytes of output."""
+    if pack is None:
+        pack = pack_numpy if numpy is not None else pack_bytes
+    while size is None or size > 0:
+        want = CHUNK_SIZE if size is None else min(size, CHUNK_SIZE)
+        data = f.read(want)
+        n = len(data) - len(data)%16
+        if n:
+            out.write(pack(data[:n], offset))
+            offset += n
+        if size is not None:
+            size -= len(data)
+        if len(data) < want:
             break
-        bits = 0
-        for n in unpack(data):
-            assert -0x2000 <= n <= 0x1fff, hex(n)
-            bits = (bits<<14) + (n&0x3fff)
-            #if i == 0: print(hex(n), hex(bits), file=sys.stderr)
-        out.write(bits.to_bytes(14, 'big'))
-
-main()
+
+class DoubleBuffer:
+    """writes to out from a background thread, so that writing one chunk
+    overlaps with converting the next. at most two chunks are queued,
+    which keeps memory use constant when the reader is slow."""
+
+    def __init__(self, out, depth=2):
+        self.out = out
+        self.queue = queue.Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            buf = self.queue.get()
+            if buf is None:
+                break
+            if self.error is None:
+                try:
+                    self.out.write(buf)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, buf):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(buf)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self.out.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def range_error(offset, n):
+    return Exception("word at %#x out of 14-bit range: %s" % (offset, hex(n)))
+
+def pack_numpy(data, offset=0):
+    words = numpy.frombuffer(data, dtype='<i2')
+    if words.min() < -0x2000 or words.max() > 0x1fff:
+        i = int(numpy.argmax((words < -0x2000) | (words > 0x1fff)))
+        raise range_error(offset + 2*i, int(words[i]))
+
+    # pack each group of 4 words into the low 56 bits of a 64-bit int,
+    # then drop the high byte of each big-endian int
+    w = (words & 0x3fff).astype(numpy.uint64).reshape(-1, 4)
+    v = (w[:,0] << 42) | (w[:,1] << 28) | (w[:,2] << 14) | w[:,3]
+    return v.astype('>u8').view(numpy.uint8).reshape(-1, 8)[:,1:].tobytes()
+
+def _table(fn):
+    return bytes(fn(x) & 0xff for x in range(256))
+
+# the high byte of each word must be a sign extension of bit 13
+_valid = _table(lambda x: x < 0x20 or x >= 0xe0)
+
+# every 4 words (a, b, c, d) pack into 7 bytes. each output byte is made of
+# bits from two input bytes, so it can be computed with a pair of translate
+# tables and an OR. (L and H are the low and high bytes of each word.)
+_pack_tables = [
+    (1, _table(lambda x: (x&0x3f)<<2), 0, _table(lambda x: x>>6)),        # aH, aL
+    (0, _table(lambda x: (x&0x3f)<<2), 3, _table(lambda x: (x&0x3f)>>4)), # aL, bH
+    (3, _table(lambda x: (x&0xf)<<4),  2, _table(lambda x: x>>4)),        # bH, bL
+    (2, _table(lambda x: (x&0xf)<<4),  5, _table(lambda x: (x&0x3f)>>2)), # bL, cH
+    (5, _table(lambda x: (x&3)<<6),    4, _table(lambda x: x>>2)),        # cH, cL
+    (4, _table(lambda x: (x&3)<<6),    7, _table(lambda x: x&0x3f)),      # cL, dH
+]
+
+def pack_bytes(data, offset=0):
+    """same as pack_numpy, using only bytes slicing and translate"""
+    data = bytes(data)
+    i = data[1::2].translate(_valid).find(0)
+    if i >= 0:
+        n = int.from_bytes(data[2*i:2*i+2], byteorder='little', signed=True)
+        raise range_error(offset + 2*i, n)
+
+    n = len(data) // 8
+    out = bytearray(7*n)
+    for k, (i, ti, j, tj) in enumerate(_pack_tables):
+        x = int.from_bytes(data[i::8].translate(ti), byteorder='big')
+        y = int.from_bytes(data[j::8].translate(tj), byteorder='big')
+        out[k::7] = (x | y).to_bytes(n, byteorder='big')
+    out[6::7] = data[6::8]
+    return bytes(out)
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,10 @@
 import sys
 import argparse
+import bisect
+import itertools
+from array import array
+
+import dts
 
 """this script splits a dts file into separate tracks based on
 blu-ray chapter markings.
@@ -11,6 +16,13 @@ to get the chapter markings, run mpls_dump from bdtools 1.5
 to extract a dts core stream from a m2ts stream
 
     ffmpeg -i http://172.17.0.2:51000/stream/title1.m2ts -bsf:a dca_core -acodec copy -map 0:2 audio.dts
+
+the dts file can be - to read the stream from a pipe.
+
+chapters are cut at real frame boundaries, found with a scan of the
+stream (see dts.FrameIndex), so variable-size and padded frames are
+handled. --fixed-size instead assumes every frame looks like the first,
+which is all that can be done when reading from a pipe.
 """
 
 DTS_FRAME_SAMPLES = 512 # samples / frame
@@ -23,8 +35,11 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--assume-start", action="store_true", default=True, help="assume the first chapter is the start of the audio")
     parser.add_argument("--no-assume-start", action="store_false", dest='assume_start', help="don't assume the first chapter is the start of the audio")
+    parser.add_argument("--fixed-size", action="store_true", help="assume every frame has the same size as the first instead of indexing the stream")
+    parser.add_argument("--sidecar", action="store_true", help="keep the frame index in DTSFILE.idx, to save rescanning next time")
+    parser.add_argument("--reflink", action="store_true", help="share extents with the source file instead of copying, where the filesystem allows")
     parser.add_argument("chapters", help="path to list of chapter marks")
-    parser.add_argument("dtsfile", help="path to dts file to split")
+    parser.add_argument("dtsfile", help="path to dts file to split, or - for stdin")
     args = parser.parse_args()
 
     ticklist = []
@@ -32,7 +47,8 @@ def main():
     chapfile = args.chapters
     dtsfile = args.dtsfile
 
-    info(dtsfile)
+    src = dts.open_input(dtsfile)
+    info(src)
 
     with open(chapfile) as f:
         for line in f:
@@ -47,50 +63,82 @@ def main():
 
     sizelist = []
 
-    prev = 0
+    if src.seekable() and not args.fixed_size:
+        if dtsfile == '-':
+            # stdin redirected from a file: there's no name to keep a sidecar under
+            index = dts.scan_fd(src.fileno())
+        else:
+            index = dts.load_index(dtsfile, sidecar=args.sidecar)
+        if index.gaps:
+            print("warning: stream loses sync %d times" % (len(index.gaps) // 2))
+        prev = 0
+        for cut in cut_points(index, ticklist):
+            if cut < prev:
+                sys.exit("error: chapter marks are out of order")
+            sizelist.append(cut - prev)
+            prev = cut
+    else:
+        prev = 0
+        for tick in ticklist:
+            tick = tick - TICK_START
+            frame = int(round(tick * (DTS_HZ / TICK_HZ) / DTS_FRAME_SAMPLES))
+            bytes = (frame - prev) * DTS_FRAME_BYTES
+            prev = frame
+            sizelist.append(bytes)
+
+    for i, bytes in enumerate(sizelist):
+        track = i + 1
+        outfile = "track%02d.dts" % track
+        copy(src, outfile, bytes, reflink=args.reflink)
+
+    copyall(src, "track%02d.dts" % (len(sizelist) + 1), reflink=args.reflink)
+    src.close()
+
+def cut_points(index, ticklist):
+    """maps chapter ticks onto the byte offsets of the nearest frame boundaries"""
+    # starts[k] is the first sample of frame k; starts[-1] is the end of the stream
+    starts = array('Q', [0])
+    starts.extend(itertools.accumulate(index.samples))
+
+    cuts = []
     for tick in ticklist:
-        tick = tick - TICK_START
-        frame = int(round(tick * (DTS_HZ / TICK_HZ) / DTS_FRAME_SAMPLES))
-        bytes = (frame - prev) * DTS_FRAME_BYTES
-        prev = frame
-        sizelist.append(bytes)
-
-    with open(dtsfile, 'rb') as f:
-        for i, bytes in enumerate(sizelist):
-            track = i + 1
-            outfile = "track%02d.dts" % track
-            copy(f, outfile, bytes)
-
-        copyall(f, "track%02d.dts" % (len(sizelist) + 1))
+        target = (tick - TICK_START) * (DTS_HZ / TICK_HZ)
+        k = bisect.bisect_left(starts, target)
+        if k > 0 and (k == len(starts) or target - starts[k-1] <= starts[k] - target):
+            k -= 1
+        if k < len(index):
+            cuts.append(index.offsets[k])
+        else:
+            cuts.append(index.size)
+    return cuts
 
-def info(dtsfile):
+def info(f):
     global DTS_FRAME_BYTES
     global DTS_FRAME_SAMPLES
     global DTS_HZ
-    with open(dtsfile, 'rb') as f:
-        header = f.read(10)
-        if header[0:4] != b'\x7f\xfe\x80\x01':
-            sys.exit("error: %s is not a DTS file (header does not match)" % f.name)
-        x = int.from_bytes(header[4:10], byteorder='big')
-        fsize = (x>>20) & 0x3fff
-        nblks = (x>>34) & 0x7f
-        sfreq = (x>>10) & 0xf
-        bitrate = (x>>5) & 0x1f
-
-        if sfreq == 1: DTS_HZ = 8000.0
-        elif sfreq == 2: DTS_HZ = 16000.0
-        elif sfreq == 3: DTS_HZ = 32000.0
-        elif sfreq == 6: DTS_HZ = 11025.0
-        elif sfreq == 7: DTS_HZ = 22050.0
-        elif sfreq == 8: DTS_HZ = 44100.0
-        elif sfreq == 11: DTS_HZ = 12000.0
-        elif sfreq == 12: DTS_HZ = 24000.0
-        elif sfreq == 13: DTS_HZ = 48000.0
-        else:
-            sys.exit("error: invalid sfreq: %#x" % sfreq)
-
-        DTS_FRAME_BYTES = fsize + 1
-        DTS_FRAME_SAMPLES = 32 * (nblks + 1)
+    header = f.peek(10)
+    if header[0:4] != dts.SYNC:
+        sys.exit("error: %s is not a DTS file (header does not match)" % f.name)
+    x = int.from_bytes(header[4:10], byteorder='big')
+    fsize = (x>>20) & 0x3fff
+    nblks = (x>>34) & 0x7f
+    sfreq = (x>>10) & 0xf
+    bitrate = (x>>5) & 0x1f
+
+    if sfreq == 1: DTS_HZ = 8000.0
+    elif sfreq == 2: DTS_HZ = 16000.0
+    elif sfreq == 3: DTS_HZ = 32000.0
+    elif sfreq == 6: DTS_HZ = 11025.0
+    elif sfreq == 7: DTS_HZ = 22050.0
+    elif sfreq == 8: DTS_HZ = 44100.0
+    elif sfreq == 11: DTS_HZ = 12000.0
+    elif sfreq == 12: DTS_HZ = 24000.0
+    elif sfreq == 13: DTS_HZ = 48000.0
+    else:
+        sys.exit("error: invalid sfreq: %#x" % sfreq)
+
+    DTS_FRAME_BYTES = fsize + 1
+    DTS_FRAME_SAMPLES = 32 * (nblks + 1)
 
     bitrates = [
           32000,   56000,   64000,   96000,  112000,
@@ -107,11 +155,16 @@ def info(dtsfile):
     print("frame samples = %#x" % DTS_FRAME_SAMPLES)
     #sys.exit(0)
 
-def copy(f, outfile, bytes):
+def copy(f, outfile, bytes, reflink=False):
     print(outfile)
     with open(outfile, "xb") as out:
+        if f.seekable():
+            # let the kernel do the copying
+            n = dts.copy_range(f.fileno(), out.fileno(), f.offset, bytes, reflink=reflink)
+            f.skip(n)
+            bytes -= n
         while bytes > 0:
-            buf = f.read(min(bytes, 4096))
+            buf = f.read(min(bytes, 1<<16))
             if not buf:
                 break
             out.write(buf)
@@ -119,11 +172,15 @@ def copy(f, outfile, bytes):
     if bytes:
         print("unexpected eof, expected %d more bytes" % bytes)
 
-def copyall(f, outfile):
+def copyall(f, outfile, reflink=False):
     print(outfile)
     with open(outfile, "xb") as out:
+        if f.seekable():
+            n = dts.copy_range(f.fileno(), out.fileno(), f.offset, reflink=reflink)
+            f.skip(n)
+            return
         while True:
-            buf = f.read(4096)
+            buf = f.read(1<<16)
             if not buf:
                 break
             out.write(buf)
@@ -0,0 +1,169 @@
+"""parses the metadata blocks at the start of a flac file.
+
+the metadata region is fetched in bulk - one read covers it for most files,
+or the file can be mmapped instead - and blocks are picked apart in memory
+rather than with a read and a seek per block header.
+
+pack_blocks and resize_block build new metadata that fits in the space the
+old metadata took up, so edits can be written without moving the audio."""
+
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+STREAMINFO = 0
+PADDING = 1
+APPLICATION = 2
+SEEKTABLE = 3
+VORBIS_COMMENT = 4
+CUESHEET = 5
+PICTURE = 6
+
+READ_SIZE = 1<<16
+
+# offset is the position of the block header in the file.
+# data is None unless the block type was asked for.
+Block = namedtuple("Block", "type, offset, length, data")
+
+class _Region:
+    """a window onto the start of a file. reads outside the window refill it."""
+    def __init__(self, f, buf):
+        self.f = f
+        self.start = 0
+        self.buf = buf
+
+    def get(self, offset, size):
+        end = offset + size
+        if self.start <= offset and end <= self.start + len(self.buf):
+            return self.buf[offset-self.start:end-self.start]
+        if self.f is None:
+            # mmapped: the window is already the whole file
+            return self.buf[offset:end]
+        self.f.seek(offset)
+        self.start = offset
+        self.buf = self.f.read(size + READ_SIZE)
+        return self.buf[:size]
+
+def read_blocks(f, want=None, use_mmap=False):
+    """reads the metadata blocks from a flac file.
+
+    returns a list of Blocks. data is loaded for blocks whose type is in want,
+    or for all blocks if want is None."""
+    if use_mmap:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise Exception("not a flac file")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return _read_blocks(_Region(None, m), want)
+    f.seek(0)
+    return _read_blocks(_Region(f, f.read(READ_SIZE)), want)
+
+def _read_blocks(r, want):
+    if r.get(0, 4) != b'fLaC':
+        raise Exception("not a flac file")
+
+    blocks = []
+    pos = 4
+    lastblock = False
+    while not lastblock:
+        header = r.get(pos, 4)
+        if not header:
+            break # eof
+        if len(header) < 4:
+            raise Exception("truncated metadata block header")
+        lastblock = header[0]&0x80 != 0
+        blocktype = header[0] & 0x7f
+        if blocktype == 0x7f:
+            raise Exception("invalid metadata block type")
+        blocklength = int.from_bytes(header[1:4], byteorder='big', signed=False)
+        data = None
+        if want is None or blocktype in want:
+            data = r.get(pos + 4, blocklength)
+            if len(data) < blocklength:
+                raise Exception("truncated metadata block")
+        blocks.append(Block(blocktype, pos, blocklength, data))
+        pos += 4 + blocklength
+
+    return blocks
+
+def find_block(blocks, blocktype):
+    for block in blocks:
+        if block.type == blocktype:
+            return block
+    return None
+
+SEEKPOINT = struct.Struct('>QQH')
+PLACEHOLDER = 0xFFFF_FFFF_FFFF_FFFF
+
+def iter_seekpoints(data):
+    """yields (sample, offset, frame_samples) for each point in a SEEKTABLE block.
+    trailing bytes that don't make up a whole seekpoint are ignored."""
+    n = len(data) // SEEKPOINT.size
+    return SEEKPOINT.iter_unpack(data[:n*SEEKPOINT.size])
+
+StreamInfo = namedtuple("StreamInfo", "min_blocksize, max_blocksize, min_framesize, max_framesize, sample_rate, channels, bits_per_sample, total_samples, md5")
+
+def parse_streaminfo(data):
+    if len(data) < 34:
+        raise Exception("truncated STREAMINFO block")
+    min_blocksize, max_blocksize = struct.unpack_from('>HH', data, 0)
+    min_framesize = int.from_bytes(data[4:7], byteorder='big')
+    max_framesize = int.from_bytes(data[7:10], byteorder='big')
+    x = int.from_bytes(data[10:18], byteorder='big')
+    sample_rate = x >> 44
+    channels = ((x >> 41) & 0x7) + 1
+    bits_per_sample = ((x >> 36) & 0x1f) + 1
+    total_samples = x & 0xf_ffff_ffff
+    return StreamInfo(min_blocksize, max_blocksize, min_framesize, max_framesize,
+                      sample_rate, channels, bits_per_sample, total_samples, bytes(data[18:34]))
+
+def audio_offset(blocks):
+    """returns the offset of the first audio frame"""
+    last = blocks[-1]
+    return last.offset + 4 + last.length
+
+MAX_BLOCK_LENGTH = (1<<24) - 1
+
+def pack_blocks(blocks, size):
+    """encodes a list of (type, data) pairs as a metadata region of exactly
+    size bytes (not counting the 'fLaC' magic), so that it can be written
+    over the old one without moving the audio.
+
+    existing PADDING blocks are dropped and a single PADDING block is added at
+    the end to make up the difference. returns None if the blocks don't fit."""
+    blocks = [(t, data) for t, data in blocks if t != PADDING]
+    room = size - sum(4 + len(data) for t, data in blocks)
+    if room < 0 or 0 < room < 4 or room - 4 > MAX_BLOCK_LENGTH:
+        return None
+    if room:
+        blocks.append((PADDING, bytes(room - 4)))
+
+    last = len(blocks) - 1
+    return b''.join(pack_block(t, data, i == last) for i, (t, data) in enumerate(blocks))
+
+def pack_block(blocktype, data, last=False):
+    if len(data) > MAX_BLOCK_LENGTH:
+        raise Exception("metadata block too large")
+    if last:
+        blocktype |= 0x80
+    return bytes([blocktype]) + len(data).to_bytes(3, byteorder='big') + data
+
+def resize_block(blocks, block, data):
+    """replaces the data of one block, growing or shrinking it into the
+    PADDING blocks right after it. returns (offset, bytes) to be written
+    to the file - only the block and its padding, nothing before or after
+    them moves - or None if the padding doesn't have room."""
+    i = blocks.index(block)
+    j = i + 1
+    while j < len(blocks) and blocks[j].type == PADDING:
+        j += 1
+    end = blocks[j-1].offset + 4 + blocks[j-1].length
+    last = j == len(blocks)
+
+    room = end - (block.offset + 4 + len(data))
+    if room < 0 or 0 < room < 4 or room - 4 > MAX_BLOCK_LENGTH:
+        return None
+    out = pack_block(block.type, data, last and not room)
+    if room:
+        out += pack_block(PADDING, bytes(room - 4), last)
+    return block.offset, out
@@ -5,75 +5,48 @@ import re
 import subprocess
 import sys
 
-this_dir = os.path.dirname(__file__)
-
-def deprefix(s, prefix):
-    if s.lower().startswith(prefix.lower()):
-        s = s[len(prefix):]
-    return s
+import tagfile
 
-def read_flac_tag(filename, tag):
-    try:
-        title = subprocess.check_output([
-            "metaflac",
-            "--show-tag="+tag,
-            filename,
-        ],
-            stderr=subprocess.DEVNULL,
-        )
-    except subprocess.CalledProcessError:
-        return ""
-
-    title = title.decode("utf-8")
-    title = deprefix(title, tag+"=")
-    title = title.strip("\n\t ")
-    return title
+this_dir = os.path.dirname(__file__)
 
-def read_ape_tag(filename, tag):
+def read_tags_subprocess(filename):
+    """reads a file's tags with the external tools, for files that
+    tagfile can't parse. returns a dict like tagfile.read_tags"""
+    if filename.endswith(".dts") or filename.endswith(".ac3"):
+        cmd = [ "python3", os.path.join(this_dir, "ape.py"), "--list", filename ]
+    elif filename.endswith(".opus"):
+        cmd = [ "opustags", filename ]
+    else:
+        cmd = [ "metaflac", "--no-utf8-convert", "--export-tags-to=-", filename ]
     try:
-        title = subprocess.check_output([
-            "python3",
-            os.path.join(this_dir, "ape.py"),
-            "--get="+tag,
-            filename,
-        ])
+        output = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
     except subprocess.CalledProcessError:
-        return ""
-
-    title = title.decode("utf-8")
-    title = title.strip("\n\t ")
-    return title
-
-_opus_cache = {}
-def read_opus_tag(filename, tag):
-    if filename in _opus_cache:
-        return _opus_cache[filename].get(tag, "")
-
+        return {}
+
+    # opustags indents the continuation lines of multi-line values
+    # with a tab; metaflac doesn't mark them at all
+    tags = []
+    for line in output.decode("utf-8").splitlines():
+        k, sep, v = line.partition('=')
+        if tags and (line.startswith("\t") or not sep):
+            k, v = tags[-1]
+            tags[-1] = (k, v + "\n" + line.lstrip("\t"))
+        elif sep:
+            tags.append((k, v))
+    return tagfile.tag_dict(tags)
+
+def read_tags(filename):
     try:
-        output = subprocess.check_output([ "opustags", filename ])
-        output = output.decode('utf-8')
-    except subprocess.CalledProcessError as e:
-        _opus_cache[filename] = {}
-        return ""
-    tags = {}
-    last_key = ""
-    for line in output.splitlines():
-        if last_key and line.startswith("\t"):
-            tags[last_key] += "\n" + line[1:]
-        else:
-            k, _, v = line.partition('=')
-            tags[k] = v
-            last_key = k
-    #print(tags)
-    _opus_cache[filename] = tags
-    return tags.get(tag, "")
+        return tagfile.cached_tags(filename)
+    except Exception:
+        # we couldn't parse the file ourselves; let the external tools have a go
+        try:
+            return tagfile.cached_tags(filename, read_tags_subprocess)
+        except OSError:
+            return {}
 
 def read_tag(filename, tag):
-    if filename.endswith(".dts") or filename.endswith(".ac3"):
-        return read_ape_tag(filename, tag)
-    if filename.endswith(".opus"):
-        return read_opus_tag(filename, tag)
-    return read_flac_tag(filename, tag)
+    return read_tags(filename).get(tag.upper(), "").strip("\n\t ")
 
 def read_title(filename):
     return read_tag(filename, 'TITLE')
@@ -109,9 +82,13 @@ def main():
     parser.add_argument('-d', '--disc', action='store_true', help="prepend disc number")
     parser.add_argument('-p', '--keep-parens', dest='parens', action='store_true', help="don't strip parentheticals")
     parser.add_argument('-a', '--artists', action='store_true', help="include artist names")
+    parser.add_argument('--cache', action='store_true', help="remember tags between runs")
     parser.add_argument('filenames', nargs='+')
     args = parser.parse_args()
 
+    if args.cache:
+        tagfile.use_disk_cache()
+
     if not args.filenames:
         print("Usage: rename.py files...")
         sys.exit(1)
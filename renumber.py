@@ -1,27 +1,80 @@
 #!/usr/bin/python
+"""sets TRACKNUMBER and TRACKTOTAL on a list of files, in the order given.
 
+works on flac, opus and apev2 (dts/ac3) files, without running metaflac.
+prints what it's going to change before changing it; files that are
+already numbered right are left alone."""
+
+import argparse
 import sys
-import subprocess
+
+import ape
+import tagfile
+
+NUMBER_TAGS = ("TRACKNUMBER", "TRACKTOTAL")
+
+def is_ape(filename):
+    return filename.endswith('.dts') or filename.endswith('.ac3')
 
 def save_tracknumber(filename, n, total):
-    subprocess.call([
-        "metaflac",
-        "--remove-tag=TRACKNUMBER",
-        "--remove-tag=TRACKTOTAL",
-        "--set-tag=TRACKNUMBER="+str(n),
-        "--set-tag=TRACKTOTAL="+str(total),
-        filename,
-    ])
+    tags = [("TRACKNUMBER", str(n)), ("TRACKTOTAL", str(total))]
+    if is_ape(filename):
+        # apev2 keys are case-insensitive, so setting them replaces the old ones
+        ape.save(filename, tags)
+        return False
+    # like metaflac --remove-tag, which ignores case
+    merge = lambda old: [(k, v) for k, v in old if k.upper() not in NUMBER_TAGS] + tags
+    return tagfile.update_tags(filename, merge)
+
+def plan(filenames):
+    """returns (filename, n, total, old) for every file that needs renumbering,
+    where old is the current (TRACKNUMBER, TRACKTOTAL), and a list of
+    (filename, error) for the files that couldn't be read"""
+    total = len(filenames)
+    changes = []
+    errors = []
+    for n, filename in enumerate(filenames, 1):
+        try:
+            tags = tagfile.cached_tags(filename)
+        except Exception as e:
+            errors.append((filename, e))
+            continue
+        old = (tags.get("TRACKNUMBER"), tags.get("TRACKTOTAL"))
+        if old != (str(n), str(total)):
+            changes.append((filename, n, total, old))
+    return changes, errors
 
 def main():
-    filenames = sys.argv[1:]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--dry-run', action='store_true', help="only show what would change")
+    parser.add_argument('-j', '--jobs', type=int, default=4, metavar='N', help="tag N files at once")
+    parser.add_argument('--cache', action='store_true', help="remember tags between runs")
+    parser.add_argument('filenames', nargs='*')
+    args = parser.parse_args()
+    filenames = args.filenames
+
+    if args.cache:
+        tagfile.use_disk_cache()
 
     if not filenames:
         print("Usage: retitle.py files...")
         sys.exit(1)
 
-    for n, filename in enumerate(filenames):
-        save_tracknumber(filename, n+1, len(filenames))
+    changes, errors = plan(filenames)
+    for filename, error in errors:
+        print("%s: %s (skipping)" % (filename, error), file=sys.stderr)
+    for filename, n, total, (oldnum, oldtotal) in changes:
+        print("%s: %s/%s -> %d/%d" % (filename, oldnum or '-', oldtotal or '-', n, total))
+    print("%d of %d files to renumber" % (len(changes), len(filenames)))
+    if args.dry_run or not changes:
+        if errors:
+            sys.exit(1)
+        return
+
+    jobs = [(filename, n, total) for filename, n, total, _ in changes]
+    ok = tagfile.report_updates(tagfile.update_many(jobs, save_tracknumber, args.jobs))
+    if errors or not ok:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,74 @@
+"""reads the header of a RIFF/WAVE file.
+
+chunks are read in order and skipped by reading, never by seeking,
+so this works on pipes as well as files."""
+
+import struct
+from collections import namedtuple
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_EXTENSIBLE = 0xfffe
+
+WaveFormat = namedtuple("WaveFormat", "format, channels, sample_rate, byte_rate, block_align, bits_per_sample")
+
+def read_exact(f, n):
+    data = f.read(n)
+    if len(data) < n:
+        raise Exception("truncated wav file")
+    return data
+
+def skip(f, n):
+    while n > 0:
+        data = f.read(min(n, 1<<16))
+        if not data:
+            raise Exception("truncated wav file")
+        n -= len(data)
+
+def parse_fmt(data):
+    if len(data) < 16:
+        raise Exception("truncated fmt chunk")
+    fmt, channels, rate, byte_rate, block_align, bits = struct.unpack_from('<HHIIHH', data)
+    if fmt == WAVE_FORMAT_EXTENSIBLE and len(data) >= 40:
+        # the real format code is the first two bytes of the subformat GUID
+        fmt, = struct.unpack_from('<H', data, 24)
+    return WaveFormat(fmt, channels, rate, byte_rate, block_align, bits)
+
+def read_header(f):
+    """reads chunks up to the start of the audio data.
+
+    returns (fmt, offset, size): the parsed fmt chunk, the offset of the audio
+    in the file, and the size of the data chunk. size is None if the writer
+    didn't know it (as when a wav is streamed to a pipe).
+    f is left positioned at the start of the audio."""
+    riff = read_exact(f, 12)
+    if riff[0:4] not in (b'RIFF', b'RF64') or riff[8:12] != b'WAVE':
+        raise Exception("not a wav file")
+    offset = 12
+
+    fmt = None
+    size64 = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise Exception("no data chunk")
+        ckid, size = struct.unpack('<4sI', header)
+        offset += 8
+        if ckid == b'data':
+            if fmt is None:
+                raise Exception("data chunk before fmt chunk")
+            if size == 0xffff_ffff and size64 is not None:
+                size = size64
+            elif size == 0 or size == 0xffff_ffff:
+                size = None
+            return fmt, offset, size
+
+        padded = size + (size & 1)
+        if ckid == b'fmt ':
+            fmt = parse_fmt(read_exact(f, padded))
+        elif ckid == b'ds64':
+            # RF64 keeps the real data size here
+            size64, = struct.unpack_from('<Q', read_exact(f, padded), 8)
+        else:
+            # LIST, fact, etc.
+            skip(f, padded)
+        offset += padded
@@ -1,139 +1,409 @@
 #!/usr/bin/env python3
 # Finds flac files that lack a SEEKTABLE chunk
 # OR that have a SEEKTABLE chunk with frame_samples=0 or PLACEHOLDER entries
+#
+# With --fix, builds a new seektable from the frame headers and writes it
+# over the old metadata, taking the space it needs out of the PADDING block,
+# so the audio doesn't have to be rewritten.
 
-import sys
 import os
-import struct
+import re
+import argparse
+import collections
+import functools
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 
-SEEK_SET = 0
-SEEK_CUR = 1
+import flacmeta
+import xdg
 
 def main():
-    args = sys.argv[1:]
-    verbose = False
-    if '-v' in args:
-        args.remove('-v')
-        verbose = True
-    if '-r' in args:
-        # recursive
-        dirs = [x for x in args if not x.startswith('-')]
-        if not dirs:
-            dirs = ['.']
-        for topdir in dirs:
-            for path, dirnames, filenames in os.walk(topdir):
-                dirnames.sort()
-                filenames = [x for x in filenames if x.endswith('.flac')]
-                filenames.sort()
-                scan_filenames([os.path.join(path, x) for x in filenames], verbose=verbose)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', dest='verbose', action='store_true', help="say what's wrong with each file")
+    parser.add_argument('-r', dest='recursive', action='store_true', help="scan directories recursively")
+    parser.add_argument('-j', dest='jobs', type=int, default=1, metavar='N', help="check N files at once")
+    parser.add_argument('--mmap', dest='use_mmap', action='store_true', help="mmap files instead of reading them")
+    parser.add_argument('--index', action='store_true', help="remember results between runs and skip files that haven't changed")
+    parser.add_argument('--incremental', action='store_true', help="only report files whose status changed since the last run (implies --index)")
+    parser.add_argument('--fix', action='store_true', help="rewrite bad seektables in place, if there is enough padding")
+    parser.add_argument('--interval', type=float, default=10, metavar='SECONDS', help="with --fix, space seekpoints this far apart (default 10)")
+    parser.add_argument('paths', nargs='*')
+    args = parser.parse_args()
+
+    if args.recursive:
+        filenames = walk(args.paths or ['.'])
     else:
-        scan_filenames(args, verbose=verbose)
+        filenames = args.paths
+
+    index = None
+    if args.index or args.incremental:
+        index = Index(open_db())
+
+    try:
+        scan_filenames(filenames, verbose=args.verbose, jobs=args.jobs, use_mmap=args.use_mmap,
+                       index=index, incremental=args.incremental,
+                       fix=args.fix, interval=args.interval)
+    finally:
+        if index is not None:
+            index.flush()
 
-def scan_filenames(filename_list, verbose=True):
+def walk(dirs):
+    for topdir in dirs:
+        for path, dirnames, filenames in os.walk(topdir):
+            dirnames.sort()
+            filenames = [x for x in filenames if x.endswith('.flac')]
+            filenames.sort()
+            for x in filenames:
+                yield os.path.join(path, x)
+
+OK = (0, 0, True)
+
+def scan_filenames(filename_list, verbose=True, jobs=1, use_mmap=False, index=None, incremental=False, fix=False, interval=10):
     def report(filename, reason):
-        if verbose:
+        if verbose or incremental:
             print("%s: %s" % (filename, reason))
         else:
             print(filename)
 
-    for filename in filename_list:
+    check = functools.partial(try_check_file, use_mmap=use_mmap, index=index, fix=fix, interval=interval)
+    for filename, (key, result, fixed) in scan(filename_list, check, jobs):
+        if isinstance(result, Exception):
+            print("Error checking %s: %s" % (filename, result))
+            continue
+        if index is not None:
+            if fixed is not None and not isinstance(fixed, Exception):
+                changed = index.update(filename, fixed, OK)
+            else:
+                changed = index.update(filename, key, result)
+            if incremental and not changed:
+                continue
+        num_placeholders, num_empty, found = result
+        if found:
+            if incremental and result == OK:
+                report(filename, "ok")
+            if num_placeholders > 0:
+                report(filename, "placeholders")
+            if num_empty > 0 and (verbose or num_placeholders == 0):
+                report(filename, "frame_samples=0")
+        else:
+            report(filename, "missing")
+        if isinstance(fixed, Exception):
+            print("Error fixing %s: %s" % (filename, fixed))
+        elif fixed is not None:
+            print("%s: fixed" % filename)
+
+def scan(filename_list, check, jobs=1):
+    """calls check on each file, yielding (filename, result) pairs in the same order as filename_list.
+
+    with jobs > 1, files are checked on a thread pool. the number of files in
+    flight is bounded, so filename_list is consumed lazily as results come back."""
+    if jobs <= 1:
+        for filename in filename_list:
+            yield filename, check(filename)
+        return
+
+    with ThreadPoolExecutor(jobs) as pool:
+        pending = collections.deque()
+        for filename in filename_list:
+            pending.append((filename, pool.submit(check, filename)))
+            if len(pending) >= jobs * 4:
+                filename, future = pending.popleft()
+                yield filename, future.result()
+        while pending:
+            filename, future = pending.popleft()
+            yield filename, future.result()
+
+def try_check_file(filename, use_mmap=False, index=None, fix=False, interval=10):
+    """returns (key, result, fixed), where key identifies the version of the file
+    that was checked (or is None if there's no index) and result is either
+    the result of check_file or an exception.
+    if the index already has a result for the file, the file isn't opened.
+
+    if fix is set and the file needs fixing, fixed is the key of the fixed
+    file or the exception that stopped us from fixing it. otherwise it's None."""
+    key = None
+    try:
+        if index is not None:
+            key = stat_key(filename)
+            result = index.lookup(key)
+        if index is None or result is None:
+            result = check_file(filename, use_mmap)
+    except Exception as e:
+        return key, e, None
+
+    fixed = None
+    if fix and result != OK:
         try:
-            with open(filename, "rb") as f:
-                pos, blocksize, found = find_seektable_block(f)
-                if found:
-                    f.seek(pos, SEEK_SET)
-                    num_placeholders, num_empty = get_seekpoint_stats(f, blocksize)
-                    if num_placeholders > 0:
-                        report(filename, "placeholders")
-                    if num_empty > 0 and (verbose or num_placeholders == 0):
-                        report(filename, "frame_samples=0")
-                else:
-                    report(filename, "missing")
-                #if not does_it_have_a_seektable_chunk(f):
-                #    print(filename, )
+            fix_file(filename, interval)
+            fixed = stat_key(filename)
         except Exception as e:
-            print("Error checking %s: %s" % (filename, e))
-
-def does_it_have_a_seektable_chunk(f):
-    magic = f.read(4)
-    if magic != b'fLaC':
-        raise Exception("not a flac file")
-
-    lastpos = 4
-    lastblock = False
-    while not lastblock:
-        chunk_header = f.read(4)
-        if not chunk_header:
-            break # eof
-        if len(chunk_header) < 4:
-            raise Exception("truncated metadata block header")
-        lastblock = chunk_header[0]&0x80 != 0
-        blocktype = chunk_header[0] & 0x7f
-        if blocktype == 0x7f:
-            raise Exception("invalid metadata block type")
-        blocklength = int.from_bytes(chunk_header[1:4], byteorder='big', signed=False)
-        pos = f.seek(blocklength, SEEK_CUR)
-        if pos != lastpos + 4 + blocklength:
-            raise Exception("truncated metadata block")
-
-        if blocktype == 3:
-            # Found a SEEKTABLE chunk
-            return True
-
-        lastpos = pos
-
-    return False
-
-def find_seektable_block(f):
-    magic = f.read(4)
-    if magic != b'fLaC':
-        raise Exception("not a flac file")
-
-    lastpos = 4
-    lastblock = False
-    while not lastblock:
-        chunk_header = f.read(4)
-        if not chunk_header:
-            break # eof
-        if len(chunk_header) < 4:
-            raise Exception("truncated metadata block header")
-        lastblock = chunk_header[0]&0x80 != 0
-        blocktype = chunk_header[0] & 0x7f
-        if blocktype == 0x7f:
-            raise Exception("invalid metadata block type")
-        blocklength = int.from_bytes(chunk_header[1:4], byteorder='big', signed=False)
-        pos = f.seek(blocklength, SEEK_CUR)
-        if pos != lastpos + 4 + blocklength:
-            raise Exception("truncated metadata block")
-
-        if blocktype == 3:
-            # Found a SEEKTABLE chunk
-            return lastpos, blocklength, True
-
-        lastpos = pos
-
-    return 0, 0, False
-
-PLACEHOLDER = 0xFFFF_FFFF_FFFF_FFFF
-
-def get_seekpoint_stats(f, blocklength):
-    unpack = struct.Struct('>QQH').unpack
-    size = struct.calcsize('>QQH')
+            fixed = e
+    return key, result, fixed
+
+def stat_key(filename):
+    st = os.stat(filename)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def open_db():
+    dbfile = os.path.join(xdg.cache_dir("seekpoints"), "index.sqlite")
+    db = sqlite3.connect(dbfile)
+    ver, = db.execute("PRAGMA user_version;").fetchone()
+
+    if ver < 1:
+        db.executescript("""
+            BEGIN;
+            CREATE TABLE IF NOT EXISTS files (
+                path BLOB PRIMARY KEY,
+                dev INTEGER,
+                ino INTEGER,
+                size INTEGER,
+                mtime INTEGER,
+                found INTEGER,
+                placeholders INTEGER,
+                empty INTEGER
+            );
+            PRAGMA user_version = 1;
+            COMMIT;
+        """).close()
+
+    return db
+
+class Index:
+    """remembers the result of checking each file, keyed by (device, inode, size, mtime).
+
+    the whole table is loaded up front so that lookups from worker threads
+    don't touch the database; updates are written back in batches from the
+    main thread."""
+
+    def __init__(self, db):
+        self.db = db
+        self.by_path = {}
+        self.by_key = {}
+        self.updates = []
+        cur = db.execute("SELECT path, dev, ino, size, mtime, found, placeholders, empty FROM files")
+        for path, dev, ino, size, mtime, found, placeholders, empty in cur:
+            key = (dev, ino, size, mtime)
+            result = (placeholders, empty, bool(found))
+            self.by_path[path] = (key, result)
+            self.by_key[key] = result
+        cur.close()
+
+    def lookup(self, key):
+        return self.by_key.get(key)
+
+    def update(self, filename, key, result):
+        """records the result for a file.
+        returns True if it differs from the file's result on the last run"""
+        path = os.fsencode(os.path.abspath(filename))
+        old = self.by_path.get(path)
+        if old == (key, result):
+            return False
+        self.by_path[path] = (key, result)
+        self.by_key[key] = result
+        placeholders, empty, found = result
+        self.updates.append((path, *key, found, placeholders, empty))
+        if len(self.updates) >= 1000:
+            self.flush()
+        return old is None or old[1] != result
+
+    def flush(self):
+        if not self.updates:
+            return
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO files(path, dev, ino, size, mtime, found, placeholders, empty) VALUES (?, ?, ?, ?, ?, ?, ?, ?)" +
+                "ON CONFLICT(path) DO UPDATE SET dev = excluded.dev, ino = excluded.ino, size = excluded.size, mtime = excluded.mtime," +
+                " found = excluded.found, placeholders = excluded.placeholders, empty = excluded.empty",
+                self.updates).close()
+        self.updates = []
+
+def check_file(filename, use_mmap=False):
+    """returns (num_placeholders, num_empty, found) for a file's seektable"""
+    with open(filename, "rb") as f:
+        blocks = flacmeta.read_blocks(f, want={flacmeta.SEEKTABLE}, use_mmap=use_mmap)
+    block = flacmeta.find_block(blocks, flacmeta.SEEKTABLE)
+    if block is None:
+        return 0, 0, False
+    num_placeholders, num_empty = get_seekpoint_stats(block.data)
+    return num_placeholders, num_empty, True
+
+def get_seekpoint_stats(data):
     num_placeholders = 0
     num_empty = 0
-    f.read(4)
-    for _ in range(blocklength//size):
-        seekpoint = f.read(size)
-        #print(seekpoint)
-        if len(seekpoint) < size:
-            raise Exception("premature end of seekpoint block")
-        sample, offset, frame_samples = unpack(seekpoint)
-        if sample == PLACEHOLDER:
+    for sample, offset, frame_samples in flacmeta.iter_seekpoints(data):
+        if sample == flacmeta.PLACEHOLDER:
             num_placeholders += 1
         elif frame_samples == 0:
             num_empty += 1
     return num_placeholders, num_empty
 
+def fix_file(filename, interval=10):
+    """replaces the file's seektable with one built from its frame headers.
+    only the metadata region is rewritten; raises an exception if the new
+    seektable doesn't fit in the space the old metadata took up."""
+    with open(filename, "r+b") as f:
+        blocks = flacmeta.read_blocks(f)
+        if blocks[0].type != flacmeta.STREAMINFO:
+            raise Exception("first metadata block is not STREAMINFO")
+        info = flacmeta.parse_streaminfo(blocks[0].data)
+        if info.total_samples == 0:
+            raise Exception("unknown stream length")
+        start = flacmeta.audio_offset(blocks)
+
+        spacing = max(1, int(interval * info.sample_rate))
+        points = []
+        target = 0
+        end = 0
+        for offset, sample, blocksize in scan_frames(f, start, info):
+            if target < sample + blocksize:
+                points.append((sample, offset - start, blocksize))
+                while target < sample + blocksize:
+                    target += spacing
+            end = sample + blocksize
+        if end != info.total_samples:
+            raise Exception("lost sync at sample %d of %d" % (end, info.total_samples))
+
+        seektable = b''.join(flacmeta.SEEKPOINT.pack(*p) for p in points)
+        newblocks = []
+        for block in blocks:
+            if block.type == flacmeta.SEEKTABLE:
+                if seektable is not None:
+                    newblocks.append((block.type, seektable))
+                    seektable = None
+            else:
+                newblocks.append((block.type, block.data))
+        if seektable is not None:
+            newblocks.insert(1, (flacmeta.SEEKTABLE, seektable))
+
+        region = flacmeta.pack_blocks(newblocks, start - 4)
+        if region is None:
+            raise Exception("not enough padding to rewrite the seektable in place")
+        f.seek(4)
+        f.write(region)
+
+SCAN_SIZE = 1<<20
+MAX_FRAME_HEADER = 16
+_frame_sync = re.compile(rb'\xff[\xf8\xf9]')
+
+def scan_frames(f, start, info):
+    """yields (offset, sample, blocksize) for every frame in the file, in order.
+
+    candidate headers are only accepted if their CRC-8 checks out and they
+    start where the previous frame left off, which rules out sync codes that
+    turn up by chance in the middle of a frame."""
+    if info.min_blocksize == info.max_blocksize:
+        fixed_blocksize = info.min_blocksize
+    else:
+        fixed_blocksize = info.max_blocksize
+    f.seek(start)
+    buf = b''
+    base = start # file offset of buf[0]
+    expected = 0
+    eof = False
+    while not eof:
+        data = f.read(SCAN_SIZE)
+        eof = not data
+        buf += data
+        limit = len(buf) if eof else len(buf) - MAX_FRAME_HEADER
+        pos = 0
+        while True:
+            m = _frame_sync.search(buf, pos)
+            if m is None or m.start() >= limit:
+                break
+            i = m.start()
+            header = parse_frame_header(buf, i, fixed_blocksize)
+            if header is not None and header[0] == expected:
+                sample, blocksize = header
+                yield base + i, sample, blocksize
+                expected = sample + blocksize
+            pos = i + 1
+        pos = max(pos, limit)
+        buf = buf[pos:]
+        base += pos
+
+def parse_frame_header(buf, i, fixed_blocksize):
+    """parses the frame header at buf[i:]. returns (sample, blocksize),
+    or None if it isn't a valid header"""
+    if len(buf) - i < 6:
+        return None
+    bscode = buf[i+2] >> 4
+    ratecode = buf[i+2] & 0xf
+    if bscode == 0 or ratecode == 0xf:
+        return None
+    if buf[i+3] >> 4 >= 11 or (buf[i+3]>>1) & 7 == 3 or buf[i+3] & 1:
+        return None
+
+    # utf-8 coded frame or sample number
+    p = i + 4
+    c = buf[p]
+    if c < 0x80:
+        n, extra = c, 0
+    elif c < 0xc0:
+        return None
+    elif c < 0xe0:
+        n, extra = c & 0x1f, 1
+    elif c < 0xf0:
+        n, extra = c & 0xf, 2
+    elif c < 0xf8:
+        n, extra = c & 0x7, 3
+    elif c < 0xfc:
+        n, extra = c & 0x3, 4
+    elif c < 0xfe:
+        n, extra = c & 0x1, 5
+    elif c == 0xfe:
+        n, extra = 0, 6
+    else:
+        return None
+    p += 1
+    if p + extra + 5 > len(buf):
+        return None
+    for c in buf[p:p+extra]:
+        if c & 0xc0 != 0x80:
+            return None
+        n = (n << 6) | (c & 0x3f)
+    p += extra
+
+    if bscode == 1:
+        blocksize = 192
+    elif bscode <= 5:
+        blocksize = 576 << (bscode - 2)
+    elif bscode == 6:
+        blocksize = buf[p] + 1
+        p += 1
+    elif bscode == 7:
+        blocksize = (buf[p] << 8 | buf[p+1]) + 1
+        p += 2
+    else:
+        blocksize = 256 << (bscode - 8)
+    if ratecode == 12:
+        p += 1
+    elif ratecode == 13 or ratecode == 14:
+        p += 2
+
+    if crc8(buf, i, p) != buf[p]:
+        return None
+
+    if buf[i+1] & 1:
+        # variable blocksize: n is the sample number
+        return n, blocksize
+    return n * fixed_blocksize, blocksize
+
+def _make_crc8_table():
+    table = []
+    for i in range(256):
+        c = i
+        for _ in range(8):
+            c = ((c << 1) ^ 0x07 if c & 0x80 else c << 1) & 0xff
+        table.append(c)
+    return table
+
+_crc8_table = _make_crc8_table()
+
+def crc8(buf, start, end):
+    c = 0
+    for b in buf[start:end]:
+        c = _crc8_table[c ^ b]
+    return c
 
 
 if __name__ == '__main__':
@@ -0,0 +1,593 @@
+"""reads tags from flac, opus, and apev2 (dts/ac3) files in-process,
+without shelling out to metaflac, opustags, or ape.py.
+
+every reader parses the file once and returns all of its tags as a dict
+mapping upper-cased tag names to values. if a tag appears more than once,
+the first value wins.
+
+cached_tags does the same through a cache of tag snapshots, so a file
+that is asked about again (in this run, or a later one if the disk cache
+is on) isn't parsed again until it changes.
+
+update_tags rewrites the comments of a flac or opus file the same way:
+one open, one read of the header, one write."""
+
+import atexit
+import json
+import os
+import struct
+import sys
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict, namedtuple
+
+import flacmeta
+import xdg
+
+SEEK_END = 2
+
+def read_tags(filename):
+    if filename.endswith(".dts") or filename.endswith(".ac3"):
+        return read_ape_tags(filename)
+    if filename.endswith(".opus"):
+        return read_opus_tags(filename)
+    return read_flac_tags(filename)
+
+_u32 = struct.Struct('<I')
+
+def parse_vorbis_comment(data):
+    """parses a vorbis comment structure (the body of a flac VORBIS_COMMENT
+    block, or an OpusTags packet minus its magic)"""
+    return tag_dict(decode_comments(split_vorbis_comment(data)[1]))
+
+def tag_dict(tags):
+    """turns a list of (name, value) into a dict the way the readers do"""
+    d = {}
+    for k, v in tags:
+        d.setdefault(k.upper(), v)
+    return d
+
+def split_vorbis_comment(data):
+    """returns (vendor, comments, end) from a vorbis comment structure.
+    the vendor string and comments are raw bytes; end is the offset just
+    past the last comment (an OpusTags packet may have padding after it)"""
+    comments = []
+    try:
+        vendor_length, = _u32.unpack_from(data, 0)
+        pos = 4 + vendor_length
+        if pos > len(data):
+            raise Exception("truncated vorbis comment")
+        vendor = bytes(data[4:pos])
+        count, = _u32.unpack_from(data, pos)
+        pos += 4
+        for _ in range(count):
+            length, = _u32.unpack_from(data, pos)
+            pos += 4
+            if pos + length > len(data):
+                raise Exception("truncated vorbis comment")
+            comments.append(bytes(data[pos:pos+length]))
+            pos += length
+    except struct.error:
+        raise Exception("truncated vorbis comment")
+    return vendor, comments, pos
+
+def decode_comments(comments):
+    """returns (name, value) for each NAME=value comment, in order.
+    names keep the case they were written in"""
+    tags = []
+    for comment in comments:
+        k, sep, v = comment.decode('utf-8', 'replace').partition('=')
+        if sep:
+            tags.append((k, v))
+    return tags
+
+def pack_vorbis_comment(vendor, tags):
+    out = [_u32.pack(len(vendor)), vendor, _u32.pack(len(tags))]
+    for k, v in tags:
+        comment = ("%s=%s" % (k, v)).encode('utf-8')
+        out.append(_u32.pack(len(comment)))
+        out.append(comment)
+    return b''.join(out)
+
+def read_flac_tags(filename):
+    with open(filename, 'rb') as f:
+        blocks = flacmeta.read_blocks(f, want={flacmeta.VORBIS_COMMENT})
+    block = flacmeta.find_block(blocks, flacmeta.VORBIS_COMMENT)
+    if block is None:
+        return {}
+    return parse_vorbis_comment(block.data)
+
+_ogg_page = struct.Struct('<4sBBqIIIB')
+
+OggPage = namedtuple("OggPage", "flags, granule, serial, seq, lacing, body")
+
+def read_ogg_page(f):
+    """reads the next page of an ogg file. returns None at eof"""
+    header = f.read(_ogg_page.size)
+    if not header:
+        return None
+    if len(header) < _ogg_page.size:
+        raise Exception("truncated ogg page")
+    magic, version, flags, granule, serial, seq, crc, nsegs = _ogg_page.unpack(header)
+    if magic != b'OggS':
+        raise Exception("not an ogg file")
+    lacing = f.read(nsegs)
+    body = f.read(sum(lacing))
+    if len(lacing) < nsegs or len(body) < sum(lacing):
+        raise Exception("truncated ogg page")
+    return OggPage(flags, granule, serial, seq, lacing, body)
+
+def pack_ogg_page(page):
+    header = _ogg_page.pack(b'OggS', 0, page.flags, page.granule, page.serial,
+                            page.seq, 0, len(page.lacing))
+    data = header + page.lacing + page.body
+    crc = _u32.pack(ogg_crc(data))
+    return data[:22] + crc + data[26:]
+
+# ogg uses the same polynomial as zlib, but shifts the other way and
+# has no pre- or post-inversion. so the crc of the bit-reversed data,
+# bit-reversed again, is the ogg crc.
+_reverse = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+def ogg_crc(data):
+    crc = zlib.crc32(data.translate(_reverse), 0xffffffff) ^ 0xffffffff
+    return int.from_bytes(crc.to_bytes(4, byteorder='little').translate(_reverse), byteorder='big')
+
+def read_ogg_packets(f, count):
+    """returns the first count packets of the first logical stream in an ogg file"""
+    packets = []
+    packet = []
+    serial = None
+    while len(packets) < count:
+        page = read_ogg_page(f)
+        if page is None:
+            raise Exception("truncated ogg page")
+        lacing, body = page.lacing, page.body
+        if serial is None:
+            serial = page.serial
+        if page.serial != serial:
+            continue
+
+        pos = 0
+        for n in lacing:
+            packet.append(body[pos:pos+n])
+            pos += n
+            if n < 255:
+                packets.append(b''.join(packet))
+                packet = []
+                if len(packets) == count:
+                    break
+
+    return packets
+
+def read_opus_tags(filename):
+    with open(filename, 'rb') as f:
+        head, comments = read_ogg_packets(f, 2)
+    if not head.startswith(b'OpusHead'):
+        raise Exception("not an opus file")
+    if not comments.startswith(b'OpusTags'):
+        raise Exception("missing OpusTags packet")
+    return parse_vorbis_comment(memoryview(comments)[8:])
+
+_ape_footer = struct.Struct('<8sIIII8x')
+APE_PREAMBLE = b'APETAGEX'
+
+def find_ape_footer(f):
+    """returns the position of the APEv2 footer, or None if the file doesn't have one.
+    the footer sits either at the very end of the file or just before an ID3v1 tag."""
+    end = f.seek(0, SEEK_END)
+    for pos in (end - _ape_footer.size, end - 128 - _ape_footer.size):
+        if pos < 0:
+            continue
+        f.seek(pos)
+        if f.read(8) == APE_PREAMBLE:
+            return pos
+    return None
+
+def read_ape_tags(filename):
+    tag = read_ape_tag(filename)
+    if tag is None:
+        return {}
+    return parse_ape_items(*tag)
+
+def read_ape_items(filename):
+    """returns the (key, flags, value) items of a file's APEv2 tag, in order,
+    with the values as raw bytes. returns None if there is no tag."""
+    tag = read_ape_tag(filename)
+    if tag is None:
+        return None
+    return list(iter_ape_items(*tag))
+
+def read_ape_tag(filename):
+    """returns the items of a file's APEv2 tag as (data, item count),
+    or None if there is no tag"""
+    with open(filename, 'rb') as f:
+        pos = find_ape_footer(f)
+        if pos is None:
+            return None
+        f.seek(pos)
+        _, version, size, count, flags = _ape_footer.unpack(f.read(_ape_footer.size))
+        itemsize = size - _ape_footer.size
+        if itemsize < 0 or itemsize > pos:
+            raise Exception("invalid APE tag size")
+        f.seek(pos - itemsize)
+        return f.read(itemsize), count
+
+def parse_ape_items(data, count):
+    tags = {}
+    for key, flags, value in iter_ape_items(data, count):
+        if (flags>>1) & 3 != 0:
+            # binary or external item
+            continue
+        # text items can hold several values separated by NULs
+        value = value.split(b'\0')[0].decode('utf-8', 'replace')
+        tags.setdefault(key.upper(), value)
+    return tags
+
+def iter_ape_items(data, count):
+    pos = 0
+    for _ in range(count):
+        if pos + 8 > len(data):
+            raise Exception("truncated APE tag")
+        length, flags = struct.unpack_from('<II', data, pos)
+        pos += 8
+        end = data.find(b'\0', pos)
+        if end < 0:
+            raise Exception("truncated APE tag")
+        key = data[pos:end].decode('ascii', 'replace')
+        pos = end + 1
+        value = data[pos:pos+length]
+        pos += length
+        yield key, flags, value
+
+# caching
+
+CACHE_SIZE = 1024
+
+class TagCache:
+    """remembers the tags of recently read files, keyed by path, size and
+    mtime. the last size files are kept in memory; if open_db has been called,
+    every file is also kept in a database, for the next run.
+
+    the dicts that come out of the cache are shared and mustn't be changed."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict() # path -> (key, tags)
+        self.lock = threading.Lock()
+        self.db = None
+        self.pending = {} # path -> (key, tags), or None to delete
+
+    def get(self, filename, read=read_tags):
+        """returns the tags of a file, calling read(filename) if they
+        aren't cached. exceptions from read aren't cached."""
+        path = os.path.abspath(filename)
+        key = stat_key(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None and self.db is not None:
+                entry = self._load(path)
+            if entry is not None and entry[0] == key:
+                self._remember(path, key, entry[1])
+                return entry[1]
+
+        tags = read(filename)
+        self.put(filename, tags, key)
+        return tags
+
+    def put(self, filename, tags, key=None):
+        path = os.path.abspath(filename)
+        if key is None:
+            key = stat_key(path)
+        with self.lock:
+            self._remember(path, key, tags)
+            if self.db is not None:
+                self._save(path, (key, tags))
+
+    def invalidate(self, filename):
+        path = os.path.abspath(filename)
+        with self.lock:
+            self.entries.pop(path, None)
+            if self.db is not None:
+                self._save(path, None)
+
+    def clear(self):
+        """forgets everything held in memory. the database is left alone"""
+        with self.lock:
+            self.entries.clear()
+
+    def _remember(self, path, key, tags):
+        self.entries[path] = (key, tags)
+        self.entries.move_to_end(path)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def open_db(self, dbfile=None):
+        """keeps the cache in dbfile (by default, tags.sqlite in
+        $XDG_CACHE_HOME/tagfile) as well as in memory"""
+        import sqlite3
+
+        if dbfile is None:
+            dbfile = os.path.join(xdg.cache_dir("tagfile"), "tags.sqlite")
+
+        db = sqlite3.connect(dbfile, timeout=30, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL").close()
+        ver, = db.execute("PRAGMA user_version;").fetchone()
+        if ver < 1:
+            db.executescript("""
+                BEGIN;
+                CREATE TABLE IF NOT EXISTS tags (
+                    path BLOB PRIMARY KEY,
+                    size INTEGER,
+                    mtime INTEGER,
+                    tags TEXT
+                );
+                PRAGMA user_version = 1;
+                COMMIT;
+            """).close()
+        with self.lock:
+            self.db = db
+        atexit.register(self.flush)
+
+    def _load(self, path):
+        if path in self.pending:
+            return self.pending[path]
+        row = self.db.execute("SELECT size, mtime, tags FROM tags WHERE path = ?",
+                              (os.fsencode(path),)).fetchone()
+        if row is None:
+            return None
+        size, mtime, tags = row
+        return (size, mtime), json.loads(tags)
+
+    def _save(self, path, entry):
+        self.pending[path] = entry
+        if len(self.pending) >= 500:
+            self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.db is None or not self.pending:
+            return
+        saves = []
+        deletes = []
+        for path, entry in self.pending.items():
+            if entry is None:
+                deletes.append((os.fsencode(path),))
+            else:
+                (size, mtime), tags = entry
+                saves.append((os.fsencode(path), size, mtime, json.dumps(tags)))
+        with self.db:
+            self.db.executemany("DELETE FROM tags WHERE path = ?", deletes).close()
+            self.db.executemany("INSERT OR REPLACE INTO tags(path, size, mtime, tags) VALUES (?, ?, ?, ?)", saves).close()
+        self.pending = {}
+
+def stat_key(path):
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns)
+
+_cache = TagCache()
+
+def cached_tags(filename, read=read_tags):
+    """like read_tags, but through the shared cache"""
+    return _cache.get(filename, read)
+
+def invalidate(filename):
+    """forgets the cached tags of a file. call this after changing its tags
+    some other way than with update_tags"""
+    _cache.invalidate(filename)
+
+def use_disk_cache(dbfile=None):
+    _cache.open_db(dbfile)
+
+# writing
+
+VENDOR = b'audiotools'
+
+# room left after the comments when a file has to be rewritten,
+# so the next few edits can be done in place
+PADDING = 8192
+
+def update_tags(filename, merge, padding=PADDING):
+    """rewrites the comments of a flac or opus file. merge is called with the
+    current comments as a list of (name, value) and returns the new list.
+
+    the file is read once, and the new comments are written over the old ones
+    when they fit; otherwise the file is copied with the new header, plus
+    padding bytes to spare, and renamed over the old one.
+    returns True if the whole file had to be rewritten."""
+    written = []
+    def keep(old):
+        written[:] = merge(old)
+        return written
+
+    try:
+        if filename.endswith(".opus"):
+            rewritten = update_opus_tags(filename, keep, padding)
+        else:
+            rewritten = update_flac_tags(filename, keep, padding)
+    except BaseException:
+        invalidate(filename)
+        raise
+    # we know what's in the file now, so there's no need to read it back
+    _cache.put(filename, tag_dict(written))
+    return rewritten
+
+def update_many(jobs, fn, workers=1):
+    """calls fn(*job) for each job, workers at a time. the first item of
+    each job is the filename, and fn returns True if it had to rewrite
+    the whole file (as update_tags does).
+    yields (filename, rewrote, error) for each job, in order"""
+    def run(job):
+        try:
+            return job[0], bool(fn(*job)), None
+        except Exception as e:
+            return job[0], False, e
+
+    if workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(workers) as pool:
+            yield from pool.map(run, jobs)
+    else:
+        yield from map(run, jobs)
+
+def report_updates(results):
+    """prints what went wrong for each (filename, rewrote, error) from
+    update_many. returns True if there were no errors"""
+    ok = True
+    for filename, rewrote, error in results:
+        if rewrote:
+            print("%s: not enough padding, rewrote the whole file" % filename, file=sys.stderr)
+        if error is not None:
+            print("%s: %s" % (filename, error), file=sys.stderr)
+            ok = False
+    return ok
+
+def update_flac_tags(filename, merge, padding=PADDING):
+    with open(filename, 'r+b') as f:
+        blocks = flacmeta.read_blocks(f)
+        offset = flacmeta.audio_offset(blocks)
+        block = flacmeta.find_block(blocks, flacmeta.VORBIS_COMMENT)
+        vendor, comments = VENDOR, []
+        if block is not None:
+            vendor, comments, _ = split_vorbis_comment(block.data)
+        data = pack_vorbis_comment(vendor, merge(decode_comments(comments)))
+
+        # best case, the comments take space from (or give it to) the
+        # padding after them and nothing else is touched
+        if block is not None:
+            change = flacmeta.resize_block(blocks, block, data)
+            if change is not None:
+                f.seek(change[0])
+                f.write(change[1])
+                return False
+
+        # otherwise gather up all the padding
+        newblocks = [(b.type, data if b is block else b.data) for b in blocks]
+        if block is None:
+            # right after STREAMINFO
+            newblocks.insert(1, (flacmeta.VORBIS_COMMENT, data))
+        region = flacmeta.pack_blocks(newblocks, offset - 4)
+        if region is not None:
+            f.seek(4)
+            f.write(region)
+            return False
+
+    size = sum(4 + len(data) for t, data in newblocks if t != flacmeta.PADDING)
+    region = flacmeta.pack_blocks(newblocks, size + (4 + padding if padding else 0))
+    rewrite_file(filename, b'fLaC' + region, offset)
+    return True
+
+def update_opus_tags(filename, merge, padding=PADDING):
+    with open(filename, 'r+b') as f:
+        first = read_ogg_page(f)
+        if first is None or not first.body.startswith(b'OpusHead'):
+            raise Exception("not an opus file")
+        start = f.tell()
+
+        # the comment header starts on the second page and ends a page
+        pages = []
+        while True:
+            page = read_ogg_page(f)
+            if page is None:
+                raise Exception("truncated ogg page")
+            if page.serial != first.serial:
+                raise Exception("multiplexed ogg streams are not supported")
+            pages.append(page)
+            ends = [i for i, n in enumerate(page.lacing) if n < 255]
+            if ends:
+                if ends != [len(page.lacing) - 1]:
+                    raise Exception("OpusTags packet doesn't end its page")
+                break
+        end = f.tell()
+
+        old = b''.join(page.body for page in pages)
+        if not old.startswith(b'OpusTags'):
+            raise Exception("missing OpusTags packet")
+        vendor, comments, pos = split_vorbis_comment(memoryview(old)[8:])
+        extra = old[8+pos:]
+        new = b'OpusTags' + pack_vorbis_comment(vendor, merge(decode_comments(comments)))
+        if extra[:1] and extra[0] & 1:
+            # binary data that has to be kept
+            new += extra
+        elif len(new) <= len(old):
+            # pad it out (padding is allowed after the comments)
+            # so the file can be written in place
+            new += bytes(len(old) - len(new))
+        else:
+            new += bytes(padding)
+
+        if len(new) == len(old):
+            newpages = [page._replace(body=new[i:i+len(page.body)])
+                        for i, page in zip(_offsets(pages), pages)]
+            f.seek(start)
+            f.write(b''.join(pack_ogg_page(page) for page in newpages))
+            return False
+
+        newpages = paginate(new, first.serial, pages[0].seq)
+        f.seek(0)
+        head = f.read(start) + b''.join(pack_ogg_page(page) for page in newpages)
+
+    delta = len(newpages) - len(pages)
+    copy = None
+    if delta:
+        copy = lambda src, dst: renumber_ogg_pages(src, dst, first.serial, delta)
+    rewrite_file(filename, head, end, copy)
+    return True
+
+def _offsets(pages):
+    pos = 0
+    for page in pages:
+        yield pos
+        pos += len(page.body)
+
+def paginate(packet, serial, seq):
+    """splits a header packet into pages, starting at page number seq"""
+    lacing = bytes([255] * (len(packet) // 255) + [len(packet) % 255])
+    pages = []
+    pos = 0
+    for i in range(0, len(lacing), 255):
+        seglacing = lacing[i:i+255]
+        size = sum(seglacing)
+        last = i + 255 >= len(lacing)
+        pages.append(OggPage(1 if i else 0, 0 if last else -1, serial, seq + len(pages),
+                             seglacing, packet[pos:pos+size]))
+        pos += size
+    return pages
+
+def renumber_ogg_pages(src, dst, serial, delta):
+    """copies pages from src to dst, adding delta to the page numbers of the stream serial"""
+    while True:
+        page = read_ogg_page(src)
+        if page is None:
+            break
+        if page.serial == serial:
+            page = page._replace(seq=page.seq + delta)
+        dst.write(pack_ogg_page(page))
+
+def rewrite_file(filename, head, offset, copy=None):
+    """replaces filename with head followed by the rest of the old file from
+    offset on, passed through copy(src, dst) if given. the new file is written
+    beside the old one and renamed over it, so the old file is left alone if
+    anything goes wrong."""
+    import dts
+
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp-', suffix=os.path.basename(filename))
+    try:
+        with open(filename, 'rb') as src, open(fd, 'wb') as dst:
+            os.chmod(tmpname, os.fstat(src.fileno()).st_mode & 0o7777)
+            dst.write(head)
+            if copy is None:
+                dst.flush()
+                dts.copy_range(src.fileno(), dst.fileno(), offset)
+            else:
+                src.seek(offset)
+                copy(src, dst)
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""keeps an index of a music library in sqlite: every file's tags,
+its STREAMINFO (or the opus equivalent) and the state of its seektable.
+
+    tagindex.py update ~/music          # crawl; only changed files are read
+    tagindex.py missing TRACKTOTAL     # files without a TRACKTOTAL tag
+    tagindex.py seektable              # flac files with a bad or missing seektable
+    tagindex.py ctdb                   # albums whose toc isn't in ctdb.py's cache
+    tagindex.py query "SELECT ..."     # anything else
+
+queries only look at the index, so run update first."""
+
+import argparse
+import os
+import struct
+import sys
+
+import flacmeta
+import seekpoints
+import tagfile
+import xdg
+
+AUDIO_EXTENSIONS = (".flac", ".opus", ".dts", ".ac3")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', metavar='FILE', help="index file (default: $XDG_CACHE_HOME/tagindex/index.sqlite)")
+    sub = parser.add_subparsers(dest='command', metavar='command')
+    sub.required = True
+
+    p = sub.add_parser('update', help="add new and changed files to the index, and drop deleted ones")
+    p.add_argument('-j', dest='jobs', type=int, default=4, metavar='N', help="read N files at once")
+    p.add_argument('paths', nargs='+')
+    p.set_defaults(func=cmd_update)
+
+    p = sub.add_parser('missing', help="list files that lack any of the given tags")
+    p.add_argument('tags', nargs='+', metavar='tag')
+    p.set_defaults(func=cmd_missing)
+
+    p = sub.add_parser('seektable', help="list flac files with a missing or broken seektable")
+    p.set_defaults(func=cmd_seektable)
+
+    p = sub.add_parser('ctdb', help="list albums whose toc isn't in ctdb.py's cache")
+    p.set_defaults(func=cmd_ctdb)
+
+    p = sub.add_parser('query', help="run an sql query against the index")
+    p.add_argument('sql')
+    p.add_argument('params', nargs='*')
+    p.set_defaults(func=cmd_query)
+
+    args = parser.parse_args()
+    db = open_db(args.db)
+    args.func(db, args)
+
+def open_db(dbfile=None):
+    import sqlite3
+
+    if dbfile is None:
+        dbfile = os.path.join(xdg.cache_dir("tagindex"), "index.sqlite")
+
+    db = sqlite3.connect(dbfile, timeout=30)
+    db.execute("PRAGMA journal_mode = WAL;").close()
+    db.execute("PRAGMA foreign_keys = ON;").close()
+    ver, = db.execute("PRAGMA user_version;").fetchone()
+
+    if ver < 1:
+        # seektable is NULL for files that aren't flac, otherwise one of
+        # the states below. the streaminfo columns are NULL if unknown
+        db.executescript("""
+            BEGIN;
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path BLOB UNIQUE,
+                dir BLOB,
+                size INTEGER,
+                mtime INTEGER,
+                format TEXT,
+                sample_rate INTEGER,
+                channels INTEGER,
+                bits_per_sample INTEGER,
+                total_samples INTEGER,
+                seektable TEXT,
+                error TEXT
+            );
+            CREATE TABLE IF NOT EXISTS tags (
+                file INTEGER REFERENCES files(id) ON DELETE CASCADE,
+                name TEXT,
+                value TEXT
+            );
+            CREATE INDEX IF NOT EXISTS tags_file ON tags(file);
+            CREATE INDEX IF NOT EXISTS tags_name ON tags(name, value);
+            CREATE INDEX IF NOT EXISTS files_dir ON files(dir);
+            PRAGMA user_version = 1;
+            COMMIT;
+        """).close()
+
+    return db
+
+# seektable states
+MISSING = "missing"
+PLACEHOLDERS = "placeholders"
+EMPTY = "frame_samples=0"
+OK = "ok"
+
+def walk(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for x in sorted(filenames):
+                if x.endswith(AUDIO_EXTENSIONS):
+                    yield os.path.join(dirpath, x)
+
+def under(path, roots):
+    return any(path == root or path.startswith(root.rstrip(b'/') + b'/') for root in roots)
+
+BATCH_SIZE = 500
+
+def cmd_update(db, args):
+    known = {path: (size, mtime) for path, size, mtime in db.execute("SELECT path, size, mtime FROM files")}
+    roots = [os.fsencode(os.path.abspath(p)) for p in args.paths]
+
+    seen = set()
+    def changed():
+        for filename in walk(args.paths):
+            path = os.fsencode(os.path.abspath(filename))
+            seen.add(path)
+            try:
+                st = os.stat(filename)
+            except OSError as e:
+                print("warning: %s" % e, file=sys.stderr)
+                continue
+            if known.get(path) != (st.st_size, st.st_mtime_ns):
+                yield filename
+
+    count = 0
+    errors = 0
+    rows = []
+    for filename, result in seekpoints.scan(changed(), read_file, args.jobs):
+        if "error" in result:
+            print("error: %s: %s" % (filename, result["error"]), file=sys.stderr)
+            errors += 1
+        rows.append(result)
+        count += 1
+        if len(rows) >= BATCH_SIZE:
+            save_files(db, rows)
+            rows = []
+    save_files(db, rows)
+
+    removed = [path for path in known if path not in seen and under(path, roots)]
+    with db:
+        db.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed]).close()
+
+    print("%d files read (%d errors), %d removed, %d unchanged" % (count, errors, len(removed), len(seen) - count),
+          file=sys.stderr)
+
+def save_files(db, rows):
+    with db:
+        for row in rows:
+            db.execute("DELETE FROM files WHERE path = ?", (row["path"],)).close()
+            cur = db.execute(
+                "INSERT INTO files(path, dir, size, mtime, format, sample_rate, channels, bits_per_sample, total_samples, seektable, error)" +
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (row["path"], os.path.dirname(row["path"]), row["size"], row["mtime"], row["format"],
+                 row.get("sample_rate"), row.get("channels"), row.get("bits_per_sample"), row.get("total_samples"),
+                 row.get("seektable"), row.get("error")))
+            file_id = cur.lastrowid
+            cur.close()
+            db.executemany("INSERT INTO tags(file, name, value) VALUES (?, ?, ?)",
+                           [(file_id, k, v) for k, v in row.get("tags", [])]).close()
+
+def read_file(filename):
+    """returns a row for the index. problems reading the file end up in
+    the error column, so that the file isn't read again until it changes"""
+    row = {"path": os.fsencode(os.path.abspath(filename)), "format": os.path.splitext(filename)[1][1:]}
+    try:
+        # stat before opening, so that a file we can't open still gets
+        # the key cmd_update compares against
+        st = os.stat(filename)
+        row["size"] = st.st_size
+        row["mtime"] = st.st_mtime_ns
+        with open(filename, 'rb') as f:
+            if filename.endswith(".flac"):
+                read_flac(f, row)
+            elif filename.endswith(".opus"):
+                read_opus(f, row)
+        if filename.endswith((".dts", ".ac3")):
+            read_ape(filename, row)
+    except Exception as e:
+        row["error"] = str(e)
+        row.setdefault("size", None)
+        row.setdefault("mtime", None)
+    return row
+
+def read_flac(f, row):
+    blocks = flacmeta.read_blocks(f, want={flacmeta.STREAMINFO, flacmeta.VORBIS_COMMENT, flacmeta.SEEKTABLE})
+    block = flacmeta.find_block(blocks, flacmeta.STREAMINFO)
+    if block is not None:
+        si = flacmeta.parse_streaminfo(block.data)
+        row.update(sample_rate=si.sample_rate, channels=si.channels,
+                   bits_per_sample=si.bits_per_sample, total_samples=si.total_samples or None)
+
+    block = flacmeta.find_block(blocks, flacmeta.SEEKTABLE)
+    if block is None:
+        row["seektable"] = MISSING
+    else:
+        placeholders, empty = seekpoints.get_seekpoint_stats(block.data)
+        row["seektable"] = PLACEHOLDERS if placeholders else EMPTY if empty else OK
+
+    block = flacmeta.find_block(blocks, flacmeta.VORBIS_COMMENT)
+    if block is not None:
+        row["tags"] = comment_tags(block.data)
+
+OPUS_RATE = 48000
+
+def read_opus(f, row):
+    head, comments = tagfile.read_ogg_packets(f, 2)
+    if not head.startswith(b'OpusHead') or len(head) < 19:
+        raise Exception("not an opus file")
+    if not comments.startswith(b'OpusTags'):
+        raise Exception("missing OpusTags packet")
+    pre_skip, = struct.unpack_from('<H', head, 10)
+    row.update(sample_rate=OPUS_RATE, channels=head[9])
+    granule = last_granule(f)
+    if granule is not None:
+        row["total_samples"] = max(0, granule - pre_skip)
+    row["tags"] = comment_tags(memoryview(comments)[8:])
+
+def last_granule(f, size=1<<16):
+    """returns the granule position of the last page that has one"""
+    end = f.seek(0, tagfile.SEEK_END)
+    f.seek(max(0, end - size))
+    tail = f.read()
+    pos = len(tail)
+    while True:
+        pos = tail.rfind(b'OggS', 0, pos)
+        if pos < 0 or pos + 14 > len(tail):
+            return None
+        granule, = struct.unpack_from('<q', tail, pos + 6)
+        if granule != -1:
+            return granule
+
+def read_ape(filename, row):
+    items = tagfile.read_ape_items(filename) or []
+    tags = []
+    for key, flags, value in items:
+        if (flags >> 1) & 3 != 0:
+            # binary or external item
+            continue
+        for v in value.split(b'\0'):
+            tags.append((key.upper(), v.decode('utf-8', 'replace')))
+    row["tags"] = tags
+
+def comment_tags(data):
+    return [(k.upper(), v) for k, v in tagfile.decode_comments(tagfile.split_vorbis_comment(data)[1])]
+
+def print_paths(cur):
+    for path, in cur:
+        print(os.fsdecode(path))
+    cur.close()
+
+def cmd_missing(db, args):
+    tags = [t.upper() for t in args.tags]
+    print_paths(db.execute(
+        "SELECT path FROM files WHERE error IS NULL AND (" +
+        " OR ".join(["NOT EXISTS (SELECT 1 FROM tags WHERE file = files.id AND name = ?)"] * len(tags)) +
+        ") ORDER BY path", tags))
+
+def cmd_seektable(db, args):
+    for path, state in db.execute("SELECT path, seektable FROM files WHERE seektable != ? ORDER BY path", (OK,)):
+        print("%s: %s" % (os.fsdecode(path), state))
+
+def cmd_ctdb(db, args):
+    import ctdb
+
+    tracks = {}
+    for file_id, name, value in db.execute("SELECT file, name, value FROM tags WHERE name IN ('DISCNUMBER', 'TRACKNUMBER')"):
+        tracks.setdefault(file_id, {}).setdefault(name, value)
+
+    # grouped the same way as ctdb.find_albums
+    albums = {}
+    for file_id, path, dirname, rate, channels, bits, samples in db.execute(
+            "SELECT id, path, dir, sample_rate, channels, bits_per_sample, total_samples FROM files" +
+            " WHERE format = 'flac' AND error IS NULL"):
+        tags = tracks.get(file_id, {})
+        disc = tags.get("DISCNUMBER", "").split("/")[0].strip()
+        info = ctdb.TrackInfo(rate, channels, bits, samples)
+        albums.setdefault(dirname, {}).setdefault(disc, []).append((ctdb.track_number(tags), path, info))
+
+    tocs = {}
+    for dirname, discs in sorted(albums.items()):
+        for disc in sorted(discs, key=ctdb.track_number_key):
+            name = os.fsdecode(dirname)
+            if len(discs) > 1:
+                name = "%s (disc %s)" % (name, disc)
+            files = sorted(discs[disc])
+            if any(info.samples is None for _, _, info in files):
+                print("warning: %s: unknown track length" % name, file=sys.stderr)
+                continue
+            try:
+                toc = ctdb.toc_from_infos([os.fsdecode(path) for _, path, _ in files], [info for _, _, info in files])
+            except Exception as e:
+                print("warning: %s" % e, file=sys.stderr)
+                continue
+            tocs[name] = ':'.join(str(x) for x in toc)
+
+    uncached = set(ctdb.uncached_tocs(list(set(tocs.values()))))
+    for name, tocstr in tocs.items():
+        if tocstr in uncached:
+            print("%s\t%s" % (name, tocstr))
+
+def cmd_query(db, args):
+    cur = db.execute(args.sql, args.params)
+    for row in cur:
+        print("\t".join(os.fsdecode(x) if isinstance(x, bytes) else str(x) for x in row))
+    cur.close()
+
+if __name__ == '__main__':
+    main()
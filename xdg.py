@@ -0,0 +1,13 @@
+"""where the scripts keep their caches"""
+
+import os
+
+def cache_dir(name):
+    """returns $XDG_CACHE_HOME/name (~/.cache/name by default),
+    creating it and any missing parents"""
+    cachedir = os.environ.get("XDG_CACHE_HOME")
+    if not cachedir:
+        cachedir = os.path.expanduser("~/.cache")
+    cachedir = os.path.join(cachedir, name)
+    os.makedirs(cachedir, exist_ok=True)
+    return cachedir